@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+import io
+import multiprocessing
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+from PIL import Image
+
+from smartdisplay.frames import convert_frame
+
+ITERATIONS = 20
+
+# The size an image was decoded at and its number of bands.
+Decoded = Tuple[Tuple[int, int], int]
+
+
+def full_decode(data: bytes) -> Decoded:
+    with Image.open(io.BytesIO(data)) as im:
+        im.load()
+        decoded = (im.size, len(im.getbands()))
+        convert_frame(im)
+    return decoded
+
+
+def thumbnail_decode(data: bytes) -> Decoded:
+    # What get_album_art used to do, thumbnail() drafts to twice the size.
+    with Image.open(io.BytesIO(data)) as im:
+        im.draft(im.mode, (128, 128))
+        decoded = (im.size, len(im.getbands()))
+        convert_frame(im)
+    return decoded
+
+
+def draft_decode(data: bytes) -> Decoded:
+    # The same as decode_frames().
+    with Image.open(io.BytesIO(data)) as im:
+        im.draft(im.mode, (64, 64))
+        decoded = (im.size, len(im.getbands()))
+        convert_frame(im)
+    return decoded
+
+
+VARIANTS: Dict[str, Callable[[bytes], Decoded]] = {
+    "full": full_decode,
+    "thumbnail": thumbnail_decode,
+    "draft": draft_decode,
+}
+
+
+def measure(variant: str, data: bytes) -> Tuple[Decoded, float, int]:
+    # Run in a fresh process that only has Pillow and the conversion code
+    # loaded. The peak RSS is reset just before the first decode, ru_maxrss
+    # can't be used as Linux carries it over from the parent across exec.
+    func = VARIANTS[variant]
+    warm_up(data)
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    baseline = memory_status("VmRSS")
+    decoded = func(data)
+    peak = memory_status("VmHWM") - baseline
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func(data)
+    elapsed = (time.perf_counter() - start) / ITERATIONS
+
+    return decoded, elapsed, peak
+
+
+def warm_up(data: bytes) -> None:
+    # Decodes a tiny image in the same format, so loading the codec isn't
+    # counted as part of the peak.
+    with Image.open(io.BytesIO(data)) as im:
+        image_format = im.format
+    buffer = io.BytesIO()
+    Image.new("RGB", (8, 8)).save(buffer, image_format)
+    full_decode(buffer.getvalue())
+
+
+def memory_status(field: str) -> int:
+    # In KiB.
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def sample_image() -> bytes:
+    im = Image.effect_mandelbrot((640, 640), (-2.0, -1.5, 1.0, 1.5), 100)
+    buffer = io.BytesIO()
+    Image.merge("RGB", (im, im.rotate(90), im.rotate(180))) \
+        .save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def main(paths: List[str]) -> None:
+    images = [(path, open(path, "rb").read()) for path in paths]
+    if len(images) == 0:
+        images = [("sample 640x640 JPEG", sample_image())]
+
+    context = multiprocessing.get_context("spawn")
+    for name, data in images:
+        print(f"{name} ({len(data)} bytes)")
+        for variant in VARIANTS:
+            with context.Pool(1) as pool:
+                (size, bands), elapsed, peak = pool.apply(
+                    measure, (variant, data))
+            # An estimate from the decoded size, Pillow pads RGB to 4 bytes
+            # a pixel.
+            decoded = size[0] * size[1] * bands
+            print(f"  {variant:10} decoded at {size[0]}x{size[1]:<5} "
+                  f"{elapsed * 1000:7.2f} ms/image  "
+                  f"peak +{peak:5} KiB  "
+                  f"~{decoded // 1024} KiB of pixels (estimate)")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+
+import argparse
+from collections import defaultdict
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+# The data each screen fetches once it is shown, as the display does.
+SCREEN_ROUTES: Dict[str, List[str]] = {
+    "house_temperature": ["/house_temperature"],
+    "air_quality": ["/air_quality"],
+    "solar": ["/solar"],
+    "water_gas": ["/water_gas"],
+    "current_weather": ["/current_weather"],
+    "trains_to_london": ["/trains_to_london"],
+    "trains_home": ["/trains_from_london"],
+    "sonos": ["/sonos", "/sonos/art"],
+    "sonos_quick": ["/sonos"],
+}
+
+
+class Stats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, List[float]] = defaultdict(list)
+        self._errors: Dict[str, int] = defaultdict(int)
+
+    def add(self, route: str, latency: float, ok: bool) -> None:
+        with self._lock:
+            self._latencies[route].append(latency)
+            if not ok:
+                self._errors[route] += 1
+
+    def report(self, elapsed: float) -> None:
+        print(f"{'route':22} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} "
+              f"{'p99 ms':>8} {'max ms':>8} {'errors':>7}")
+        with self._lock:
+            routes = sorted(self._latencies.items())
+            errors = dict(self._errors)
+        for route, latencies in routes:
+            latencies = sorted(latencies)
+            print(f"{route:22} {len(latencies) / elapsed:8.1f} "
+                  f"{percentile(latencies, 50) * 1000:8.1f} "
+                  f"{percentile(latencies, 90) * 1000:8.1f} "
+                  f"{percentile(latencies, 99) * 1000:8.1f} "
+                  f"{latencies[-1] * 1000:8.1f} "
+                  f"{errors.get(route, 0) / len(latencies):7.1%}")
+
+
+def percentile(values: List[float], percent: int) -> float:
+    return values[min(len(values) - 1, len(values) * percent // 100)]
+
+
+class Display:
+    def __init__(self,
+                 name: str,
+                 host: str,
+                 port: int,
+                 screen_seconds: float,
+                 stats: Stats) -> None:
+        self.name = name
+        self.host = host
+        self.port = port
+        self.screen_seconds = screen_seconds
+        self.stats = stats
+        self._connection: Optional[http.client.HTTPConnection] = None
+
+    def run(self, until: float) -> None:
+        # Start at a random point so displays don't all ask at once.
+        time.sleep(random.uniform(0, self.screen_seconds))
+        current = "clock"
+        while time.time() < until:
+            status, body = self.get("/next_screen", f"?current={current}")
+            if status == 200:
+                current = json.loads(body)
+                for route in SCREEN_ROUTES.get(current, []):
+                    self.get(route)
+            # The display shows each screen for about the same time.
+            time.sleep(self.screen_seconds * random.uniform(0.9, 1.1))
+
+    def get(self, route: str, query: str = "") -> Tuple[int, bytes]:
+        start = time.perf_counter()
+        try:
+            if self._connection is None:
+                self._connection = http.client.HTTPConnection(
+                    self.host, self.port, timeout=30)
+            self._connection.request("GET", route + query,
+                                     headers={"X-Display-Id": self.name})
+            response = self._connection.getresponse()
+            body = response.read()
+            status = response.status
+            if response.will_close:
+                self._connection.close()
+                self._connection = None
+        except (OSError, http.client.HTTPException):
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            status, body = 0, b""
+        # A 404 is a panel without data, not a failure of the backend.
+        self.stats.add(route, time.perf_counter() - start,
+                       status in (200, 404))
+        return status, body
+
+
+def start_backend(replay: str, port: int) -> subprocess.Popen:
+    env = dict(os.environ)
+    env["SMARTDISPLAY_REPLAY"] = replay
+    env.setdefault("SMARTDISPLAY_REPLAY_SPEED", "0")
+    server = os.path.join(os.path.dirname(__file__), "server.py")
+    # Its access log would drown out the report.
+    backend = subprocess.Popen([sys.executable, server, str(port)],
+                               env=env,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    # Wait for it to start listening.
+    for _ in range(100):
+        try:
+            http.client.HTTPConnection("localhost", port, timeout=1).connect()
+            return backend
+        except OSError:
+            time.sleep(0.1)
+    backend.kill()
+    raise RuntimeError("Backend didn't start")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Simulates displays following the screen rotation.")
+    parser.add_argument("--url", default="http://localhost:8080",
+                        help="backend to load, unless --replay is given")
+    parser.add_argument("--replay",
+                        help="start a local backend replaying this "
+                             "recording instead of using the upstreams")
+    parser.add_argument("--displays", type=int, default=10)
+    parser.add_argument("--screen-seconds", type=float, default=10.0,
+                        help="how long each screen is shown for")
+    parser.add_argument("--duration", type=float, default=60.0)
+    args = parser.parse_args()
+
+    url = urlparse(args.url)
+    host, port = url.hostname or "localhost", url.port or 80
+    backend = None
+    if args.replay is not None:
+        host = "localhost"
+        backend = start_backend(args.replay, port)
+
+    try:
+        stats = Stats()
+        start = time.time()
+        threads = []
+        for index in range(args.displays):
+            display = Display(f"load-{index}", host, port,
+                              args.screen_seconds, stats)
+            thread = threading.Thread(target=display.run,
+                                      args=(start + args.duration,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        print(f"{args.displays} displays for {args.duration:.0f}s")
+        stats.report(time.time() - start)
+    finally:
+        if backend is not None:
+            backend.terminate()
+            backend.wait()
+
+
+if __name__ == "__main__":
+    main()
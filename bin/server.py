@@ -9,6 +9,13 @@ import sentry_sdk  # type:ignore
 from smartdisplay import SmartDisplayHandler
 
 
+class SmartDisplayServer(socketserver.ThreadingTCPServer):
+    # Displays hold their connections open between requests, so each one
+    # needs its own thread to avoid blocking the others.
+    allow_reuse_address = True
+    daemon_threads = True
+
+
 def main(port) -> None:
     sentry_sdk.init(
         dsn=os.environ.get("SENTRY_DSN"),
@@ -16,8 +23,7 @@ def main(port) -> None:
         profiles_sample_rate=0.0,
     )
 
-    with socketserver.TCPServer(("", port), SmartDisplayHandler) as httpd:
-        httpd.allow_reuse_address = True
+    with SmartDisplayServer(("", port), SmartDisplayHandler) as httpd:
         print("serving at port", port)
         httpd.serve_forever()
 
@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+
+from collections import defaultdict
+import json
+import sys
+from typing import Any, Dict, List, Tuple
+
+# Spans listed for each route.
+TOP_SPANS = 5
+
+
+def load_traces(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf8") as f:
+        return [json.loads(line) for line in f if line.strip() != ""]
+
+
+def report(traces: List[Dict[str, Any]]) -> None:
+    routes: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for trace in traces:
+        routes[trace["name"]].append(trace)
+
+    for name, route_traces in sorted(routes.items()):
+        durations = sorted(trace["duration"] for trace in route_traces)
+        print(f"{name}: {len(durations)} traces, "
+              f"p50 {durations[len(durations) // 2] * 1000:.1f} ms, "
+              f"max {durations[-1] * 1000:.1f} ms")
+
+        spans: Dict[Tuple[str, str], List[float]] = defaultdict(list)
+        for trace in route_traces:
+            for span in trace["spans"]:
+                spans[(span["op"], span["description"])] \
+                    .append(span["duration"])
+        # Ordered by the time they cost the route in total.
+        for (op, description), times in sorted(
+                spans.items(), key=lambda item: -sum(item[1]))[:TOP_SPANS]:
+            print(f"  {sum(times) * 1000:9.1f} ms total "
+                  f"{max(times) * 1000:8.1f} ms max "
+                  f"{len(times):5}x  {op} {description}")
+
+
+if __name__ == "__main__":
+    report(load_traces(sys.argv[1]))
@@ -6,4 +6,10 @@ mypy -m smartdisplay
 
 mypy bin/server.py
 
-${PYCODESTYLE:-pycodestyle} bin/server.py smartdisplay/
+mypy bin/benchmark_album_art.py
+
+mypy bin/load_generator.py
+
+mypy bin/trace_report.py
+
+${PYCODESTYLE:-pycodestyle} bin/ smartdisplay/
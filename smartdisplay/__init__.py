@@ -1 +1,14 @@
-from .smart_display_handler import SmartDisplayHandler
+from typing import Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .smart_display_handler import SmartDisplayHandler
+
+
+# Importing the handler starts the server's background threads, so it is only
+# imported when asked for. Tools such as bin/benchmark_album_art.py can then
+# import the conversion code on its own.
+def __getattr__(name: str) -> Any:
+    if name == "SmartDisplayHandler":
+        from .smart_display_handler import SmartDisplayHandler
+        return SmartDisplayHandler
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
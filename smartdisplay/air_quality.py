@@ -1,16 +1,18 @@
-from typing import Dict
+from typing import Any, Dict
 
-from prometheus_api_client import PrometheusConnect  # type:ignore
+from .panel_cache import panel_cache
+from .prometheus import Panel
 
 
-def get_air_quality() -> Dict[str, float | str]:
-    prom = PrometheusConnect(url="http://192.168.1.207:9090")
+@panel_cache()
+def get_air_quality() -> Dict[str, Any]:
+    panel = Panel("air_quality")
 
-    co2: float = _get_query(prom, "avg_over_time(bge_co2[5m])")
-    voc = _get_query(prom, "avg_over_time(bge_voc[5m])")
-    pm25 = _get_query(prom,
-                      "avg_over_time("
-                      + "bge_airqual_standard{psize=\"2.5\"}[10m])")
+    co2 = panel.query("co2", "avg_over_time(bge_co2[5m])")
+    voc = panel.query("voc", "avg_over_time(bge_voc[5m])")
+    pm25 = panel.query("pm25",
+                       "avg_over_time("
+                       + "bge_airqual_standard{psize=\"2.5\"}[10m])")
 
     if co2 < 500:
         co2_level = "Great"
@@ -57,17 +59,11 @@ def get_air_quality() -> Dict[str, float | str]:
     else:
         voc_text = f"{int(voc)} ppb"
 
-    return {
+    return panel.result({
         "co2": co2_text,
         "co2_level": co2_level,
         "voc": voc_text,
         "voc_level": voc_level,
         "pm25": f"{int(pm25)} ug/m3",
         "pm25_level": pm25_level
-    }
-
-
-def _get_query(prom: PrometheusConnect, query: str) -> float:
-    data = prom.custom_query(query)
-
-    return float(data[0]["value"][1])
+    })
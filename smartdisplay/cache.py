@@ -0,0 +1,182 @@
+from collections import OrderedDict
+import functools
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, \
+                   ParamSpec, Tuple, TypeVar
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+KiB = 1024
+MiB = 1024 * KiB
+
+# Returned by CacheRegion.get() when there is nothing usable, since None can
+# be a cached value.
+MISSING: Any = object()
+
+
+def estimate_size(value: Any) -> int:
+    # Good enough to budget with, shared objects are counted every time.
+    if isinstance(value, memoryview):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray, str)):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            estimate_size(key) + estimate_size(item)
+            for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(item)
+                                          for item in value)
+    return sys.getsizeof(value)
+
+
+class _Entry:
+    def __init__(self,
+                 value: Any,
+                 size: int,
+                 expires: Optional[float]) -> None:
+        self.value = value
+        self.size = size
+        self.expires = expires
+
+
+# Entries are evicted least recently used first once the region is over its
+# budget. Expired entries are kept until then, so they can still be used as
+# a fallback when a refresh fails.
+class CacheRegion:
+    def __init__(self,
+                 name: str,
+                 budget: int,
+                 ttl: Optional[float] = None,
+                 sizeof: Callable[[Any], int] = estimate_size) -> None:
+        self.name = name
+        self.budget = budget
+        self.ttl = ttl
+        self.sizeof = sizeof
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Called with the key, or None for everything, after an invalidation.
+        self._listeners: List[Callable[[Optional[Hashable]], None]] = []
+
+    def get(self, key: Hashable, stale: bool = False) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None \
+               or (not stale and entry.expires is not None
+                   and entry.expires <= now):
+                self.misses += 1
+                return MISSING
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def put(self, key: Hashable, value: Any,
+            ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        size = self.sizeof(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.budget:
+                return
+            self._entries[key] = _Entry(value, size, expires)
+            self._size += size
+            while self._size > self.budget:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._size = 0
+            else:
+                self._remove(key)
+        for listener in self._listeners:
+            listener(key)
+
+    def on_invalidate(self,
+                      listener: Callable[[Optional[Hashable]], None]) -> None:
+        self._listeners.append(listener)
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        with self._lock:
+            return [(key, entry.value) for key, entry in self._entries.items()]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "budget": self.budget,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+
+
+class CacheManager:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._regions: Dict[str, CacheRegion] = {}
+
+    def region(self,
+               name: str,
+               budget: int,
+               ttl: Optional[float] = None,
+               sizeof: Callable[[Any], int] = estimate_size) -> CacheRegion:
+        with self._lock:
+            if name in self._regions:
+                raise ValueError(f"Cache region {name} already exists")
+            region = CacheRegion(name, budget, ttl, sizeof)
+            self._regions[name] = region
+            return region
+
+    def __iter__(self) -> Iterator[CacheRegion]:
+        with self._lock:
+            return iter(list(self._regions.values()))
+
+    def get(self, name: str) -> Optional[CacheRegion]:
+        with self._lock:
+            return self._regions.get(name)
+
+    def stats(self) -> Dict[str, Any]:
+        regions = {region.name: region.stats() for region in self}
+        return {
+            "bytes": sum(stats["bytes"] for stats in regions.values()),
+            "budget": sum(stats["budget"] for stats in regions.values()),
+            "regions": regions,
+        }
+
+
+CACHES = CacheManager()
+
+
+# Like lru_cache, keyed on the arguments, but bounded by the region budget.
+def cached(region: CacheRegion) -> Callable[[Callable[P, T]], Callable[P, T]]:
+    def decorator(func: Callable[P, T]) -> Callable[P, T]:
+        @functools.wraps(func)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+            key = (func.__qualname__, args, tuple(sorted(kwargs.items())))
+            value = region.get(key)
+            if value is MISSING:
+                value = func(*args, **kwargs)
+                region.put(key, value)
+            return value
+        return wrapper
+    return decorator
@@ -0,0 +1,68 @@
+import threading
+import time
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self,
+                 name: str,
+                 failure_threshold: int = 3,
+                 reset_timeout: float = 30.0) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+    def call(self, func: Callable[[], T]) -> T:
+        self._before_call()
+        try:
+            result = func()
+        except Exception:
+            self._record_failure()
+            raise
+        self._record_success()
+        return result
+
+    def _before_call(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._trial_running or \
+               time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"{self.name} is unavailable")
+            # Half open, let a single call through to see if the upstream
+            # has recovered.
+            self._trial_running = True
+
+    def _record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None \
+               or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f"Circuit for {self.name} opened after "
+                          f"{self._failures} failures")
+                self._opened_at = time.monotonic()
+
+    def _record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                print(f"Circuit for {self.name} closed")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
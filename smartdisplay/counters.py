@@ -0,0 +1,123 @@
+from collections import deque
+import json
+import threading
+import time
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from .prometheus import custom_query
+
+DAY = 24 * 60 * 60
+
+# If we haven't seen a counter for this long the samples in between are lost,
+# so the baseline is reloaded rather than trusted.
+REBASELINE_GAP = 15 * 60
+
+# Panels often use the same counter more than once per refresh.
+MIN_UPDATE_INTERVAL = 5
+
+# Samples closer together than this are thinned out, which keeps a day of a
+# series to around 1440 samples whatever the scrape interval.
+SAMPLE_SPACING = 60
+
+
+class _Series:
+    def __init__(self) -> None:
+        # Values have resets already added back in, so any sample can be
+        # dropped without losing one.
+        self.samples: Deque[Tuple[float, float]] = deque()
+        self.offset = 0.0
+        self.last_raw: Optional[float] = None
+
+
+# Stands in for increase(selector[window]), or delta() when resets is False.
+# A single range query loads the baseline, after that only instant queries
+# are made and their samples accumulated locally.
+class IncrementalCounter:
+    def __init__(self,
+                 selector: str,
+                 window: int = DAY,
+                 resets: bool = True) -> None:
+        self.selector = selector
+        self.window = window
+        self.resets = resets
+
+        self._lock = threading.Lock()
+        self._series: Dict[str, _Series] = {}
+        self._last_update: Optional[float] = None
+
+    def value(self) -> Optional[float]:
+        with self._lock:
+            now = time.time()
+            if self._last_update is None \
+               or now - self._last_update > REBASELINE_GAP:
+                self._load_baseline()
+                self._last_update = now
+            elif now - self._last_update > MIN_UPDATE_INTERVAL:
+                self._update()
+                self._last_update = now
+            start = now - self.window
+            self._expire(start)
+
+            if len(self._series) == 0:
+                return None
+            return sum(_increase(series.samples, start)
+                       for series in self._series.values())
+
+    def _load_baseline(self) -> None:
+        data = custom_query(f"{self.selector}[{self.window}s]")
+        self._series = {}
+        for series in data:
+            loaded = _Series()
+            for t, v in series["values"]:
+                self._add(loaded, float(t), float(v))
+            self._series[_series_key(series["metric"])] = loaded
+
+    def _update(self) -> None:
+        for series in custom_query(self.selector):
+            self._add(self._series.setdefault(_series_key(series["metric"]),
+                                              _Series()),
+                      float(series["value"][0]),
+                      float(series["value"][1]))
+
+    def _add(self, series: _Series, t: float, raw: float) -> None:
+        samples = series.samples
+        if len(samples) > 0 and samples[-1][0] >= t:
+            return
+        # A drop means the counter was reset and restarted from zero.
+        if self.resets and series.last_raw is not None \
+           and raw < series.last_raw:
+            series.offset += series.last_raw
+        series.last_raw = raw
+
+        sample = (t, raw + series.offset)
+        # The latest sample is replaced until it is far enough from the one
+        # before it to keep.
+        if len(samples) > 1 \
+           and samples[-1][0] - samples[-2][0] < SAMPLE_SPACING:
+            samples[-1] = sample
+        else:
+            samples.append(sample)
+
+    def _expire(self, start: float) -> None:
+        # The last sample before the window is kept so the change across the
+        # start of the window can be apportioned.
+        for key, series in list(self._series.items()):
+            samples = series.samples
+            while len(samples) > 1 and samples[1][0] <= start:
+                samples.popleft()
+            if samples[-1][0] < start:
+                del self._series[key]
+
+
+def _increase(samples: Deque[Tuple[float, float]], start: float) -> float:
+    total = samples[-1][1] - samples[0][1]
+    if len(samples) > 1 and samples[0][0] < start:
+        # Only the part of the first change after the start of the window.
+        first, second = samples[0], samples[1]
+        total -= (second[1] - first[1]) * (start - first[0]) \
+            / (second[0] - first[0])
+    return total
+
+
+def _series_key(metric: Dict[str, Any]) -> str:
+    return json.dumps(metric, sort_keys=True)
@@ -1,55 +1,96 @@
+from collections import deque
+import threading
 import time
-from typing import Dict, Tuple
+from typing import Any, Deque, Dict, Optional, Tuple
 
-from prometheus_api_client import PrometheusConnect  # type:ignore
+from .panel_cache import panel_cache
+from .prometheus import Panel, PrometheusUnavailable
 
 UVI_QUERY = "avg_over_time(prom433_uvi{model=\"Fineoffset-WS90\"}[30m])"
 
 RAIN_QUERY = "increase(prom433_rain{model=\"Fineoffset-WS90\"}[%s])"
 
 
+# The weather station reports on a fixed schedule, learnt from the changes to
+# last_message. Messages can be missed between polls, so the shortest recent
+# gap is taken as the schedule.
+class StationCadence:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._last_message: Optional[float] = None
+        self._gaps: Deque[float] = deque(maxlen=10)
+
+    def observe(self, last_message: float) -> None:
+        with self._lock:
+            if self._last_message is not None \
+               and last_message > self._last_message:
+                self._gaps.append(last_message - self._last_message)
+            self._last_message = last_message
+
+    def next_message_in(self) -> Optional[float]:
+        with self._lock:
+            if self._last_message is None or len(self._gaps) == 0:
+                return None
+            return self._last_message + min(self._gaps) - time.time()
+
+
+STATION = StationCadence()
+
+
+def _next_message(data: Dict[str, Any]) -> Optional[float]:
+    return STATION.next_message_in()
+
+
+# An age in seconds, which would be wrong once restored from a snapshot.
+@panel_cache(warm_start=False)
 def get_current_weather_last_update() -> float:
-    prom = PrometheusConnect(url="http://192.168.1.207:9090")
+    panel = Panel("current_weather_last_update")
 
-    last_message = _get_weather_metric(prom, "last_message")
+    try:
+        last_message = _get_weather_metric(panel, "last_message")
+    except PrometheusUnavailable:
+        last_message = None
     if last_message is None:
         return 24 * 60 * 60
 
+    STATION.observe(last_message)
     return time.time() - last_message
 
 
-def get_current_weather() -> Dict[str, float | str | None]:
-    prom = PrometheusConnect(url="http://192.168.1.207:9090")
+@panel_cache(hint=_next_message)
+def get_current_weather() -> Dict[str, Any]:
+    panel = Panel("current_weather")
 
-    pressure, pressure_change, pressure_text = get_pressure(prom)
+    pressure, pressure_change, pressure_text = get_pressure(panel)
 
-    uv = _get_weather_query(prom, UVI_QUERY)
+    uv = _get_weather_query(panel, "uv", UVI_QUERY)
 
-    return {
-        "temperature": _get_weather_metric(prom, "temperature"),
-        "humidity": _get_weather_metric(prom, "humidity"),
-        "lux": _get_weather_metric(prom, "light_lux"),
+    return panel.result({
+        "temperature": _get_weather_metric(panel, "temperature"),
+        "humidity": _get_weather_metric(panel, "humidity"),
+        "lux": _get_weather_metric(panel, "light_lux"),
         "uv": round(uv) if uv is not None else None,
-        "gust": _get_weather_metric(prom, "wind_max_m"),
-        "wind": _get_weather_metric(prom, "wind_avg_m"),
-        "winddir": get_wind_dir(prom),
-        "rain_24h": _get_weather_query(prom, RAIN_QUERY % ("24h", )),
-        "rain_1h": _get_weather_query(prom, RAIN_QUERY % ("1h", )),
-        "rain_20m": _get_weather_query(prom, RAIN_QUERY % ("20m", )),
+        "gust": _get_weather_metric(panel, "wind_max_m"),
+        "wind": _get_weather_metric(panel, "wind_avg_m"),
+        "winddir": get_wind_dir(panel),
+        "rain_24h": _get_weather_query(panel, "rain_24h",
+                                       RAIN_QUERY % ("24h", )),
+        "rain_1h": _get_weather_query(panel, "rain_1h",
+                                      RAIN_QUERY % ("1h", )),
+        "rain_20m": _get_weather_query(panel, "rain_20m",
+                                       RAIN_QUERY % ("20m", )),
         "pressure": pressure,
         "pressure_change": pressure_change,
         "pressure_text": pressure_text
-    }
+    })
 
 
-def get_pressure(prom: PrometheusConnect) -> Tuple[float, str, str]:
-    data = prom.get_current_metric_value(metric_name="bge_pressure")
-    if len(data) == 0:
+def get_pressure(panel: Panel) -> Tuple[float, str, str]:
+    pressure = panel.optional_metric("pressure", "bge_pressure")
+    if pressure is None:
         return 1000.0, "level", "Unknown"
 
-    pressure = float(data[0]["value"][1])
-
-    change = _get_weather_query(prom,
+    change = _get_weather_query(panel, "pressure_change",
                                 "bge_pressure - (bge_pressure offset 2h)")
 
     if pressure < 965:
@@ -73,8 +114,8 @@ def get_pressure(prom: PrometheusConnect) -> Tuple[float, str, str]:
         return pressure, "level", text
 
 
-def get_wind_dir(prom: PrometheusConnect) -> str:
-    direction = _get_weather_query(prom,
+def get_wind_dir(panel: Panel) -> str:
+    direction = _get_weather_query(panel, "winddir",
                                    "avg_over_time(prom433_wind_dir_deg[15m])")
 
     if direction is None:
@@ -98,22 +139,14 @@ def get_wind_dir(prom: PrometheusConnect) -> str:
     return "N"
 
 
-def _get_weather_metric(prom: PrometheusConnect, metric: str) -> float | None:
-    data = prom.get_current_metric_value(metric_name='prom433_' + metric,
-                                         label_config={"model":
-                                                       "Fineoffset-WS90"})
-
-    if len(data) == 0:
-        return None
-    return float(data[0]["value"][1])
-
+def _get_weather_metric(panel: Panel, metric: str) -> float | None:
+    return panel.optional_metric(metric,
+                                 'prom433_' + metric,
+                                 {"model": "Fineoffset-WS90"})
 
-def _get_weather_query(prom: PrometheusConnect, query: str) -> float | None:
-    data = prom.custom_query(query)
 
-    if len(data) == 0:
-        return None
-    return float(data[0]["value"][1])
+def _get_weather_query(panel: Panel, field: str, query: str) -> float | None:
+    return panel.optional_query(field, query)
 
 
 if __name__ == "__main__":
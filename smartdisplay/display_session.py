@@ -0,0 +1,97 @@
+from datetime import datetime, UTC
+import threading
+from typing import Dict, List, Optional
+
+from .sonos import TrackInfo
+
+# Sessions for displays that haven't been seen for this long are dropped.
+SESSION_EXPIRY = 24 * 60 * 60
+
+# Gaps between screens longer than this are the display being switched off,
+# not a screen being shown.
+MAX_SCREEN_DURATION = 10 * 60
+
+
+class DisplaySession:
+    def __init__(self, display_id: str) -> None:
+        self.display_id = display_id
+        self.last_screen = "sonos"
+        self.last_seen = datetime.now(UTC)
+        self._last_track_info: Optional[TrackInfo] = None
+        self._track_shown_at: Optional[datetime] = None
+        self._last_display_time: Optional[datetime] = None
+        self._last_screen_request: Optional[datetime] = None
+        self.screen_duration: Optional[float] = None
+
+    def has_track_changed(self, track_info: Optional[TrackInfo]) -> bool:
+        if track_info is None:
+            self._last_display_time = None
+            self._last_track_info = None
+            return False
+        if self._last_track_info is None \
+                or track_info != self._last_track_info:
+            self._last_track_info = track_info
+            self._track_shown_at = track_info.created
+            self._last_display_time = datetime.now(UTC)
+            return True
+        gap = datetime.now(UTC) - (self._track_shown_at or track_info.created)
+        if abs(gap.total_seconds()) > 60 * 5:
+            self._track_shown_at = datetime.now(UTC)
+            self._last_display_time = datetime.now(UTC)
+            return True
+        return False
+
+    def show_quick(self) -> bool:
+        if self._last_display_time is None:
+            return False
+        if (datetime.now(UTC) - self._last_display_time).total_seconds() \
+           > 2 * 60:
+            self._last_display_time = datetime.now(UTC)
+            return True
+        return False
+
+    def screen_requested(self) -> None:
+        # A smoothed gap between next_screen requests estimates how long the
+        # display shows each screen for.
+        now = datetime.now(UTC)
+        if self._last_screen_request is not None:
+            gap = (now - self._last_screen_request).total_seconds()
+            if gap < MAX_SCREEN_DURATION:
+                if self.screen_duration is None:
+                    self.screen_duration = gap
+                else:
+                    self.screen_duration += (gap - self.screen_duration) / 4
+        self._last_screen_request = now
+
+    def set_last_screen(self, screen: str) -> None:
+        self.last_screen = screen
+
+    def get_last_screen(self) -> str:
+        return self.last_screen
+
+
+class SessionRegistry:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, DisplaySession] = {}
+
+    def get(self, display_id: str) -> DisplaySession:
+        now = datetime.now(UTC)
+        with self._lock:
+            session = self._sessions.get(display_id)
+            if session is None:
+                print(f"New display session {display_id}")
+                session = DisplaySession(display_id)
+                self._sessions[display_id] = session
+                self._expire(now)
+            session.last_seen = now
+            return session
+
+    def sessions(self) -> List[DisplaySession]:
+        with self._lock:
+            return list(self._sessions.values())
+
+    def _expire(self, now: datetime) -> None:
+        for display_id, session in list(self._sessions.items()):
+            if (now - session.last_seen).total_seconds() > SESSION_EXPIRY:
+                del self._sessions[display_id]
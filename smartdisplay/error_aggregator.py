@@ -0,0 +1,107 @@
+import hashlib
+import queue
+import re
+import sys
+import threading
+import time
+from typing import Dict, Set, Tuple
+
+from sentry_sdk import capture_message  # type:ignore
+
+# Repeats of an error are summarised once per window rather than forwarded.
+ERROR_WINDOW = 5 * 60
+
+NUMBER_RE = re.compile(r"0x[0-9a-fA-F]+|\d+")
+
+
+def fingerprint(message: str) -> str:
+    # Addresses, line numbers and counters vary between otherwise identical
+    # crashes.
+    normalised = NUMBER_RE.sub("#", message.strip())
+    return hashlib.sha1(normalised.encode("utf8")).hexdigest()
+
+
+class _ErrorCount:
+    def __init__(self, message: str) -> None:
+        self.message = message
+        self.repeats = 0
+        self.displays: Set[str] = set()
+
+
+class ErrorAggregator:
+    def __init__(self, window: float = ERROR_WINDOW,
+                 max_pending: int = 100) -> None:
+        self.window = window
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._errors: Dict[str, _ErrorCount] = {}
+        self._queue: queue.Queue[Tuple[str, str, str]] = \
+            queue.Queue(maxsize=max_pending)
+
+        self._thread = threading.Thread(target=self._forwarder)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, display: str, message: str) -> None:
+        key = fingerprint(message)
+        with self._lock:
+            error = self._errors.get(key)
+            if error is not None:
+                error.repeats += 1
+                error.displays.add(display)
+                return
+            self._errors[key] = _ErrorCount(message)
+        self._forward(key, display, message)
+
+    def _forward(self, key: str, display: str, message: str) -> None:
+        try:
+            self._queue.put_nowait((key, display, message))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _forwarder(self) -> None:
+        next_summary = time.monotonic() + self.window
+        while True:
+            try:
+                key, display, message = self._queue.get(
+                    timeout=max(0.0, next_summary - time.monotonic()))
+                # Sentry groups by the fingerprint, so the first occurrence
+                # and its summaries share one issue.
+                capture_message(message, fingerprint=[key],
+                                tags={"display": display})
+                sys.stderr.write(f"[{display}] {message.rstrip()}\n")
+                sys.stderr.flush()
+            except queue.Empty:
+                pass
+
+            if time.monotonic() >= next_summary:
+                self._summarise()
+                next_summary = time.monotonic() + self.window
+
+    def _summarise(self) -> None:
+        with self._lock:
+            repeated = [(key, error) for key, error in self._errors.items()
+                        if error.repeats > 0]
+            # Errors that didn't repeat are forgotten, so the next occurrence
+            # is forwarded in full again.
+            self._errors = {key: error for key, error in self._errors.items()
+                            if error.repeats > 0}
+            summaries = [(key, error.message, error.repeats,
+                          sorted(error.displays)) for key, error in repeated]
+            for _, error in repeated:
+                error.repeats = 0
+                error.displays = set()
+            dropped, self.dropped = self.dropped, 0
+
+        for key, message, repeats, displays in summaries:
+            capture_message(message, fingerprint=[key],
+                            extras={"repeats": repeats,
+                                    "window": int(self.window),
+                                    "displays": displays})
+            sys.stderr.write(f"Repeated {repeats} times in the last "
+                             f"{int(self.window)}s by {', '.join(displays)}: "
+                             f"{message.rstrip()}\n")
+        if dropped > 0:
+            sys.stderr.write(f"Dropped {dropped} errors\n")
+        sys.stderr.flush()
@@ -0,0 +1,104 @@
+# Conversion to the display's wire format. Only needs Pillow, so it can be
+# used without the rest of the server.
+
+import math
+import struct
+from typing import BinaryIO, List, Optional, Tuple
+
+from PIL import Image
+
+WIDTH = 64
+HEIGHT = 64
+FRAME_SIZE = WIDTH * HEIGHT * 3
+
+HEADER = b"I75v1" + bytes([WIDTH, HEIGHT, 3])
+ANIMATION_HEADER = b"I75a1" + bytes([WIDTH, HEIGHT, 3])
+
+# Animations longer than this are truncated to keep the response small.
+MAX_FRAMES = 100
+DEFAULT_FRAME_DURATION = 100
+
+# A frame in the display's wire format and how long to show it for in ms.
+# The pixels are a view into a buffer that starts with HEADER, see
+# with_header().
+Frame = Tuple[memoryview, int]
+
+
+def with_header(pixels: memoryview) -> memoryview:
+    return memoryview(pixels.obj)
+
+
+def decode_frames(fp: BinaryIO) -> Optional[List[Frame]]:
+    with Image.open(fp) as im:
+        try:
+            n_frames = min(getattr(im, "n_frames", 1), MAX_FRAMES)
+            if n_frames == 1:
+                # Lets JPEGs be decoded at a fraction of their size, 640x640
+                # art comes out at 80x80.
+                im.draft(im.mode, (WIDTH, HEIGHT))
+                return [(convert_frame(im), 0)]
+
+            frames: List[Frame] = []
+            for index in range(n_frames):
+                im.seek(index)
+                duration = int(im.info.get("duration") or 0)
+                if duration <= 0:
+                    duration = DEFAULT_FRAME_DURATION
+                frames.append((convert_frame(im.convert("RGB")),
+                               min(duration, 0xFFFF)))
+            return frames
+        except OSError:
+            return None
+
+
+def convert_frame(im: Image.Image) -> memoryview:
+    if im.width > WIDTH or im.height > HEIGHT:
+        im.thumbnail((WIDTH, HEIGHT), Image.Resampling.NEAREST)
+    xsize, ysize = im.size
+
+    frame = Image.new("RGB", (WIDTH, HEIGHT))
+    frame.paste(im.convert("RGB"), (math.floor((WIDTH - xsize) / 2.0),
+                                    math.floor((HEIGHT - ysize) / 2.0)))
+    return memoryview(HEADER + frame.tobytes())[len(HEADER):]
+
+
+def encode_animation(frames: List[Frame]) -> bytes:
+    # Each frame only carries the pixels that differ from the previous one,
+    # the first is relative to a blank screen. Layout, all big endian:
+    #   header, frame count (H)
+    #   per frame: duration ms (H), run count (H)
+    #     per run: first pixel (H), pixel count (H), pixel count * RGB
+    data = bytearray(ANIMATION_HEADER)
+    data.extend(struct.pack(">H", len(frames)))
+
+    previous = memoryview(bytes(FRAME_SIZE))
+    for frame, duration in frames:
+        runs = _changed_runs(previous, frame)
+        data.extend(struct.pack(">HH", duration, len(runs)))
+        for start, length in runs:
+            data.extend(struct.pack(">HH", start, length))
+            data.extend(frame[start * 3:(start + length) * 3])
+        previous = frame
+
+    return bytes(data)
+
+
+def _changed_runs(previous: memoryview,
+                  frame: memoryview) -> List[Tuple[int, int]]:
+    runs: List[Tuple[int, int]] = []
+    start: Optional[int] = None
+    last_changed = 0
+    for pixel in range(WIDTH * HEIGHT):
+        offset = pixel * 3
+        if previous[offset:offset + 3] == frame[offset:offset + 3]:
+            continue
+        # A single unchanged pixel costs less to resend than a new run.
+        if start is not None and pixel - last_changed > 2:
+            runs.append((start, last_changed - start + 1))
+            start = None
+        if start is None:
+            start = pixel
+        last_changed = pixel
+    if start is not None:
+        runs.append((start, last_changed - start + 1))
+    return runs
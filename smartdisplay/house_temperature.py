@@ -1,6 +1,7 @@
-from typing import Dict
+from typing import Any, Dict
 
-from prometheus_api_client import PrometheusConnect  # type:ignore
+from .panel_cache import panel_cache
+from .prometheus import Panel
 
 ROOMS = [
     "lounge",
@@ -12,33 +13,26 @@ ROOMS = [
 ]
 
 
-def get_house_temperature() -> Dict[str, float]:
-    prom = PrometheusConnect(url="http://192.168.1.207:9090")
+@panel_cache()
+def get_house_temperature() -> Dict[str, Any]:
+    panel = Panel("house_temperature")
 
-    labels = {"model": "Fineoffset-WS90"}
-    outside = prom.get_current_metric_value(metric_name='prom433_temperature',
-                                            label_config=labels)
-
-    data = {}
+    data: Dict[str, Any] = {}
 
     for room in ROOMS:
-        try:
-            data[room] = _get_room_temperature(prom, room)
-        except IndexError:
-            pass
-
-    try:
-        data["outside"] = float(outside[0]["value"][1])
-    except IndexError:
-        pass
-
-    return data
-
-
-def _get_room_temperature(prom: PrometheusConnect, room: str) -> float:
-    data = prom.get_current_metric_value(metric_name='prom433_temperature',
-                                         label_config={"room": room})
-    return float(data[0]["value"][1])
+        temperature = panel.optional_metric(room,
+                                            "prom433_temperature",
+                                            {"room": room})
+        if temperature is not None:
+            data[room] = temperature
+
+    outside = panel.optional_metric("outside",
+                                    "prom433_temperature",
+                                    {"model": "Fineoffset-WS90"})
+    if outside is not None:
+        data["outside"] = outside
+
+    return panel.result(data)
 
 
 if __name__ == "__main__":
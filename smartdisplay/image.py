@@ -1,57 +1,49 @@
 #!/usr/bin/python3
 
-from functools import lru_cache
 import re
-import math
-import struct
-from typing import Optional, List
+from typing import List, Optional
 
-from PIL import Image
+from .cache import CACHES, MiB, cached
+from .frames import Frame, decode_frames, encode_animation
+from .tracing import span
 
+# Local images, converted and as animations.
+IMAGES = CACHES.region("images", 8 * MiB)
 
-@lru_cache(maxsize=20)
-def load_image(art_uri: str) -> Optional[bytes]:
-    if not re.match(r"\w+.png|\w+/\w+.png", art_uri):
+
+def load_image(art_uri: str) -> Optional[memoryview]:
+    frames = load_frames(art_uri)
+    if frames is None:
+        return None
+    return frames[0][0]
+
+
+def raw_image_path(art_uri: str) -> Optional[str]:
+    # Images already in the wire format are sent straight from disk.
+    if not re.fullmatch(r"\w+\.raw|\w+/\w+\.raw", art_uri):
+        print(f"Invalid url {art_uri}")
+        return None
+    return "images/" + art_uri
+
+
+def is_raw_image(art_uri: str) -> bool:
+    return art_uri.endswith(".raw")
+
+
+@cached(IMAGES)
+def load_animation(art_uri: str) -> Optional[bytes]:
+    frames = load_frames(art_uri)
+    if frames is None:
+        return None
+    with span("image.encode", art_uri):
+        return encode_animation(frames)
+
+
+@cached(IMAGES)
+def load_frames(art_uri: str) -> Optional[List[Frame]]:
+    if not re.match(r"\w+.(png|gif)|\w+/\w+.(png|gif)", art_uri):
         print(f"Invalid url {art_uri}")
         return None
 
-    image_data: List[int] = []
-    with Image.open(open("images/"+art_uri, "rb")) as im:
-        if im.width > 64 or im.height > 64:
-            try:
-                im.thumbnail((64, 64), Image.Resampling.NEAREST)
-            except OSError:
-                return None
-        xsize, ysize = im.size
-
-        xbefore, xafter, ybefore, yafter = 0, 0, 0, 0
-        if xsize < 64:
-            xbefore = math.floor((64 - xsize) / 2.0)
-            xafter = math.ceil((64 - xsize) / 2.0)
-        if ysize < 64:
-            ybefore = math.floor((64 - ysize) / 2.0)
-            yafter = math.ceil((64 - ysize) / 2.0)
-
-        if ybefore > 0:
-            image_data.extend([0, 0, 0] * 64 * ybefore)
-        for y in range(ysize):
-            if xbefore > 0:
-                image_data.extend([0, 0, 0] * xbefore)
-            for x in range(xsize):
-                pixel = im.getpixel((x, y))
-                if isinstance(pixel, int):
-                    r, g, b = pixel, pixel, pixel
-                elif len(pixel) == 3:
-                    r, g, b = pixel
-                elif len(pixel) == 4:
-                    r, g, b, _ = pixel
-                else:
-                    raise ValueError(f"Got {len(pixel)} colour values.")
-
-                image_data.extend([r, g, b])
-            if xafter > 0:
-                image_data.extend([0, 0, 0] * xafter)
-        if yafter > 0:
-            image_data.extend([0, 0, 0] * 64 * yafter)
-
-    return struct.pack("B" * (64 * 64 * 3), *image_data)
+    with open("images/"+art_uri, "rb") as fp, span("image.decode", art_uri):
+        return decode_frames(fp)
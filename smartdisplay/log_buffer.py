@@ -0,0 +1,60 @@
+from collections import deque
+import sys
+import threading
+import time
+from typing import Any, Deque, Dict, List, TextIO, Tuple
+
+# Sequence number, time, display and line.
+LogEntry = Tuple[int, float, str, str]
+
+
+class LogBuffer:
+    def __init__(self, capacity: int = 2000,
+                 output: TextIO = sys.stdout) -> None:
+        self.output = output
+        self._condition = threading.Condition()
+        self._entries: Deque[LogEntry] = deque(maxlen=capacity)
+        self._last_seq = 0
+        self._written_seq = 0
+
+        self._thread = threading.Thread(target=self._writer)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, display: str, data: str) -> int:
+        now = time.time()
+        with self._condition:
+            for line in data.splitlines():
+                if line.strip() == "":
+                    continue
+                self._last_seq += 1
+                self._entries.append((self._last_seq, now, display, line))
+            self._condition.notify()
+            return self._last_seq
+
+    def since(self, seq: int) -> List[Dict[str, Any]]:
+        with self._condition:
+            entries = [entry for entry in self._entries if entry[0] > seq]
+        return [{
+            "seq": entry_seq,
+            "time": entry_time,
+            "display": display,
+            "line": line
+        } for entry_seq, entry_time, display, line in entries]
+
+    def _writer(self) -> None:
+        while True:
+            with self._condition:
+                while self._written_seq == self._last_seq:
+                    self._condition.wait()
+                entries = [entry for entry in self._entries
+                           if entry[0] > self._written_seq]
+                dropped = self._last_seq - self._written_seq - len(entries)
+                self._written_seq = self._last_seq
+
+            lines = [f"[{display}] {line}\n"
+                     for _, _, display, line in entries]
+            if dropped > 0:
+                lines.insert(0, f"Dropped {dropped} log lines\n")
+            self.output.write("".join(lines))
+            self.output.flush()
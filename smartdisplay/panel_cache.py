@@ -0,0 +1,172 @@
+import functools
+import sys
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Optional, \
+                   ParamSpec, Set, Tuple, TypeVar
+
+from .cache import CACHES, MISSING, MiB
+from .refresh import AdaptiveInterval
+from .single_flight import SINGLE_FLIGHT
+from .worker_pool import BoundedExecutor
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+# The function's module and qualified name, its args and its kwargs.
+Key = Tuple[Any, ...]
+
+# Long enough for a prefetched panel to still be fresh when the display asks
+# for it, short enough that nobody notices the values lagging. Panels whose
+# data changes less often are kept for longer, up to PANEL_MAX_TTL.
+PANEL_TTL = 15.0
+PANEL_MAX_TTL = 120.0
+PANEL_BUDGET = 1 * MiB
+
+REFRESH_POOL = BoundedExecutor("panel-refresh")
+
+
+class PanelPolicy:
+    def __init__(self,
+                 min_ttl: float,
+                 max_ttl: float,
+                 hint: Optional[Callable[[Any], Optional[float]]]) -> None:
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.hint = hint
+
+
+class PanelCache:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # Expired results stay in the region until evicted, for the snapshot.
+        self.region = CACHES.region("panels", PANEL_BUDGET)
+        self.region.on_invalidate(self._invalidated)
+        # Results restored from a snapshot, served until a fetch replaces
+        # them.
+        self._warm: Dict[Key, Any] = {}
+        self._refreshing: Set[Key] = set()
+        self._persistent: Set[Tuple[str, str]] = set()
+        self._intervals: Dict[Key, AdaptiveInterval] = {}
+
+    def get(self, key: Key, func: Callable[[], T], policy: PanelPolicy
+            ) -> T:
+        value = self.region.get(key)
+        if value is not MISSING:
+            return value
+        with self._lock:
+            if key in self._warm:
+                if key not in self._refreshing \
+                   and REFRESH_POOL.submit(self._refresh,
+                                           key, func, policy) is not None:
+                    self._refreshing.add(key)
+                return self._warm[key]
+
+        # Only the caller that fetched stores the result, otherwise every
+        # caller waiting on the same fetch would count as finding it
+        # unchanged.
+        return SINGLE_FLIGHT.do(("panel",) + key,
+                                lambda: self._store(key, func(), policy))
+
+    def is_restored(self, key: Key) -> bool:
+        with self._lock:
+            return key in self._warm
+
+    def persist(self, module: str, qualname: str) -> None:
+        self._persistent.add((module, qualname))
+
+    def snapshot(self) -> List[Any]:
+        with self._lock:
+            values: Dict[Any, Any] = dict(self._warm)
+        for key, value in self.region.items():
+            assert isinstance(key, tuple)
+            if (key[0], key[1]) in self._persistent:
+                values[key] = value
+        return [[key, value] for key, value in values.items()]
+
+    def restore(self, entries: List[Any]) -> None:
+        with self._lock:
+            for key, value in entries:
+                key = _to_tuple(key)
+                if isinstance(value, dict):
+                    value["stale"] = sorted(name for name in value
+                                            if name != "stale")
+                self._warm[key] = value
+
+    def _invalidated(self, key: Optional[Hashable]) -> None:
+        # Restored results would otherwise be served in place of what was
+        # invalidated.
+        with self._lock:
+            if key is None:
+                self._warm.clear()
+            elif isinstance(key, tuple):
+                self._warm.pop(key, None)
+
+    def _refresh(self,
+                 key: Key,
+                 func: Callable[[], T],
+                 policy: PanelPolicy) -> None:
+        try:
+            self._store(key, func(), policy)
+        except Exception as e:
+            sys.stderr.write(f"Refreshing {key} failed: {e!r}\n")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _store(self, key: Key, value: T, policy: PanelPolicy) -> T:
+        hint = None if policy.hint is None else policy.hint(value)
+        with self._lock:
+            interval = self._intervals.get(key)
+            if interval is None:
+                interval = AdaptiveInterval(policy.min_ttl, policy.max_ttl)
+                self._intervals[key] = interval
+            ttl = interval.update(value, hint)
+            self._warm.pop(key, None)
+        self.region.put(key, value, ttl)
+        return value
+
+
+def _to_tuple(value: Any) -> Any:
+    if isinstance(value, list):
+        return tuple(_to_tuple(item) for item in value)
+    return value
+
+
+PANEL_CACHE = PanelCache()
+
+
+# Concurrent misses share a single fetch, so there is no need to add
+# single_flight as well.
+# Results of functions with warm_start set are saved in the snapshot. A hint
+# gives the seconds a result is known to stay current for, when there is
+# something better than the learnt interval to go on.
+def panel_cache(min_ttl: float = PANEL_TTL,
+                max_ttl: float = PANEL_MAX_TTL,
+                hint: Optional[Callable[[Any], Optional[float]]] = None,
+                warm_start: bool = True
+                ) -> Callable[[Callable[P, T]], Callable[P, T]]:
+    policy = PanelPolicy(min_ttl, max_ttl, hint)
+
+    def decorator(func: Callable[P, T]) -> Callable[P, T]:
+        if warm_start:
+            PANEL_CACHE.persist(func.__module__, func.__qualname__)
+
+        @functools.wraps(func)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+            return PANEL_CACHE.get(_key(func, args, kwargs),
+                                   lambda: func(*args, **kwargs), policy)
+        return wrapper
+    return decorator
+
+
+# Whether calling func with these arguments would return a result restored
+# from the snapshot, for results that can't be marked stale themselves.
+def is_restored(func: Callable[..., Any], *args: Any, **kwargs: Any) -> bool:
+    return PANEL_CACHE.is_restored(_key(func, args, kwargs))
+
+
+def _key(func: Callable[..., Any],
+         args: Tuple[Any, ...],
+         kwargs: Dict[str, Any]) -> Key:
+    return (func.__module__, func.__qualname__, args,
+            tuple(sorted(kwargs.items())))
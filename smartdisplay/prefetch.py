@@ -0,0 +1,82 @@
+import sys
+import threading
+from typing import Any, Callable, Dict
+
+from .air_quality import get_air_quality
+from .current_weather import get_current_weather
+from .house_temperature import get_house_temperature
+from .solar import get_current_solar
+from .trains import get_trains, get_trains_message
+from .tracing import trace
+from .water_gas import get_water_gas
+from .worker_pool import BoundedExecutor
+
+PREFETCH_POOL = BoundedExecutor("prefetch")
+
+# Seconds before a display is expected to ask for a screen that its data is
+# fetched, enough to cover a slow upstream.
+PREFETCH_LEAD = 5.0
+
+
+def _trains(route: str) -> Callable[[str], Any]:
+    # Called the same way as the handler so they share cache entries.
+    def fetch(display: str) -> Any:
+        get_trains_message(route, display)
+        return get_trains(route, display)
+    return fetch
+
+
+# Screens with data worth fetching ahead of time. Sonos album art is already
+# converted when the track changes, the other screens need nothing.
+SCREEN_DATA: Dict[str, Callable[[str], Any]] = {
+    "house_temperature": lambda display: get_house_temperature(),
+    "air_quality": lambda display: get_air_quality(),
+    "solar": lambda display: get_current_solar(),
+    "water_gas": lambda display: get_water_gas(),
+    "current_weather": lambda display: get_current_weather(),
+    "trains_to_london": _trains("to_london"),
+    "trains_home": _trains("from_london"),
+}
+
+
+class Prefetcher:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._timers: Dict[str, threading.Timer] = {}
+
+    def schedule(self, display: str, screen: str, shown_in: float) -> None:
+        # Only the latest prediction for a display matters.
+        fetch = SCREEN_DATA.get(screen)
+        with self._lock:
+            previous = self._timers.pop(display, None)
+            if previous is not None:
+                previous.cancel()
+            if fetch is None:
+                return
+            timer = threading.Timer(max(0.0, shown_in - PREFETCH_LEAD),
+                                    self._start,
+                                    (display, screen, fetch))
+            timer.daemon = True
+            self._timers[display] = timer
+            timer.start()
+
+    def _start(self,
+               display: str,
+               screen: str,
+               fetch: Callable[[str], Any]) -> None:
+        with self._lock:
+            if self._timers.get(display) is threading.current_thread():
+                del self._timers[display]
+        # Prefetching is only an optimisation, so skip it when busy.
+        PREFETCH_POOL.submit(self._fetch, display, screen, fetch)
+
+    def _fetch(self,
+               display: str,
+               screen: str,
+               fetch: Callable[[str], Any]) -> None:
+        try:
+            with trace(f"prefetch {screen}"):
+                fetch(display)
+        except Exception as e:
+            sys.stderr.write(f"Prefetching {screen} for {display} failed: "
+                             f"{e!r}\n")
@@ -0,0 +1,240 @@
+import re
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from prometheus_api_client import PrometheusConnect  # type:ignore
+from urllib3.util.retry import Retry
+
+from .cache import CACHES, MISSING, KiB
+from .circuit_breaker import CircuitBreaker
+from .recorder import PROMETHEUS, upstream_call
+
+PROMETHEUS_URL = "http://192.168.1.207:9090"
+
+# Seconds a single query may take, enforced both by the HTTP client and by
+# Prometheus itself.
+QUERY_TIMEOUT = 2.0
+
+BREAKER = CircuitBreaker("prometheus")
+
+# Results of queries over range vectors are cached for a fraction of their
+# shortest window, within these bounds.
+QUERY_CACHE = CACHES.region("promql", 512 * KiB)
+RANGE_TTL_FRACTION = 1 / 30
+MIN_QUERY_TTL = 5.0
+MAX_QUERY_TTL = 300.0
+
+DURATION_UNITS = {
+    "ms": 0.001, "s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60,
+    "w": 7 * 24 * 60 * 60, "y": 365 * 24 * 60 * 60
+}
+DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h|d|w|y)")
+STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"')
+LABELS_RE = re.compile(r"\{[^}]*\}")
+GROUPING_RE = re.compile(
+    r"\b(by|without|on|ignoring|group_left|group_right)\s*\([^)]*\)")
+# A range vector or subquery, with its window and optional resolution.
+RANGE_RE = re.compile(r"\[\s*([\w.]+)\s*(:\s*([\w.]*))?\s*\]")
+NAME_RE = re.compile(r"[a-zA-Z_:][\w:]*")
+# A query that is only a range selector, which returns every raw sample.
+MATRIX_RE = re.compile(
+    r"\s*([a-zA-Z_:][\w:]*)?\s*\[[^\]]*\]\s*(offset\s+\S+\s*)?")
+KEYWORDS = {
+    "and", "or", "unless", "by", "without", "on", "ignoring", "group_left",
+    "group_right", "offset", "bool", "inf", "nan"
+}
+
+_PROMETHEUS: Optional[PrometheusConnect] = None
+_PROMETHEUS_LOCK = threading.Lock()
+
+_LAST_KNOWN_GOOD: Dict[Tuple[str, str], float] = {}
+_LAST_KNOWN_GOOD_LOCK = threading.Lock()
+
+
+class PrometheusUnavailable(Exception):
+    pass
+
+
+def get_prometheus() -> PrometheusConnect:
+    global _PROMETHEUS
+    with _PROMETHEUS_LOCK:
+        if _PROMETHEUS is None:
+            # Retrying inside the client would multiply the deadline, the
+            # circuit breaker decides when to try again instead.
+            _PROMETHEUS = PrometheusConnect(url=PROMETHEUS_URL,
+                                            retry=Retry(total=0),
+                                            timeout=QUERY_TIMEOUT)
+        return _PROMETHEUS
+
+
+def custom_query(query: str) -> List[Dict[str, Any]]:
+    key = normalise_query(query)
+    ttl = query_ttl(key)
+    if ttl is not None:
+        data = QUERY_CACHE.get(key)
+        if data is not MISSING:
+            return data
+
+    data = BREAKER.call(lambda: upstream_call(
+        PROMETHEUS,
+        query,
+        lambda: get_prometheus().custom_query(
+            query, params={"timeout": f"{QUERY_TIMEOUT}s"})))
+    if ttl is not None:
+        QUERY_CACHE.put(key, data, ttl)
+    return data
+
+
+def normalise_query(query: str) -> str:
+    return " ".join(query.split())
+
+
+def query_ttl(query: str) -> Optional[float]:
+    # A windowed result moves slowly, a 30m average is refetched every
+    # minute. Subqueries only change once per step. Anything with an instant
+    # selector in it has to stay fresh, so isn't cached. Nor are raw samples,
+    # such as the counter baselines, which are large and read once.
+    query = GROUPING_RE.sub(
+        "", LABELS_RE.sub("", STRING_RE.sub('""', query)))
+    ranges = RANGE_RE.findall(query)
+    if len(ranges) == 0 or MATRIX_RE.fullmatch(query) \
+       or _has_instant_selector(query):
+        return None
+
+    ttl = MAX_QUERY_TTL
+    for window, subquery, step in ranges:
+        ttl = min(ttl, parse_duration(window) * RANGE_TTL_FRACTION)
+        if step != "":
+            ttl = min(ttl, parse_duration(step))
+    return ttl if ttl >= MIN_QUERY_TTL else None
+
+
+def _has_instant_selector(query: str) -> bool:
+    # Everything inside a subquery is evaluated over its range.
+    if any(subquery != "" for _, subquery, _ in RANGE_RE.findall(query)):
+        return False
+    for match in NAME_RE.finditer(query):
+        rest = query[match.end():].lstrip()
+        if match.group() in KEYWORDS or rest.startswith(("(", "[")):
+            continue
+        # Durations and numbers, such as the 2h of offset 2h.
+        if match.start() > 0 and query[match.start() - 1].isdigit():
+            continue
+        return True
+    return False
+
+
+def parse_duration(duration: str) -> float:
+    return sum(float(amount) * DURATION_UNITS[unit]
+               for amount, unit in DURATION_RE.findall(duration))
+
+
+def current_metric_value(metric: str,
+                         label_config: Optional[Dict[str, str]] = None
+                         ) -> List[Dict[str, Any]]:
+    return BREAKER.call(lambda: upstream_call(
+        PROMETHEUS,
+        selector(metric, label_config),
+        lambda: get_prometheus().get_current_metric_value(
+            metric_name=metric,
+            label_config=label_config,
+            params={"timeout": f"{QUERY_TIMEOUT}s"})))
+
+
+def last_known_good() -> List[Any]:
+    with _LAST_KNOWN_GOOD_LOCK:
+        return [[panel, field, value]
+                for (panel, field), value in _LAST_KNOWN_GOOD.items()]
+
+
+def restore_last_known_good(values: List[Any]) -> None:
+    with _LAST_KNOWN_GOOD_LOCK:
+        for panel, field, value in values:
+            _LAST_KNOWN_GOOD.setdefault((panel, field), float(value))
+
+
+def selector(metric: str,
+             label_config: Optional[Dict[str, str]] = None) -> str:
+    if not label_config:
+        return metric
+    labels = ",".join(f'{name}="{value}"'
+                      for name, value in sorted(label_config.items()))
+    return f"{metric}{{{labels}}}"
+
+
+def first_value(data: List[Dict[str, Any]]) -> Optional[float]:
+    if len(data) == 0:
+        return None
+    return float(data[0]["value"][1])
+
+
+class Panel:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.stale: List[str] = []
+
+    def query(self, field: str, query: str) -> float:
+        return self.value(field, lambda: first_value(custom_query(query)))
+
+    def optional_query(self, field: str, query: str) -> Optional[float]:
+        return self.optional_value(
+            field, lambda: first_value(custom_query(query)))
+
+    def metric(self,
+               field: str,
+               metric: str,
+               label_config: Optional[Dict[str, str]] = None) -> float:
+        return self.value(field, lambda: first_value(
+            current_metric_value(metric, label_config)))
+
+    def optional_metric(self,
+                        field: str,
+                        metric: str,
+                        label_config: Optional[Dict[str, str]] = None
+                        ) -> Optional[float]:
+        return self.optional_value(field, lambda: first_value(
+            current_metric_value(metric, label_config)))
+
+    def value(self, field: str, fetch: Callable[[], Optional[float]]) -> float:
+        value = self._fetch(field, fetch, True)
+        assert value is not None
+        return value
+
+    def optional_value(self,
+                       field: str,
+                       fetch: Callable[[], Optional[float]]
+                       ) -> Optional[float]:
+        return self._fetch(field, fetch, False)
+
+    def result(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        if len(self.stale) > 0:
+            data["stale"] = self.stale
+        return data
+
+    def _fetch(self,
+               field: str,
+               fetch: Callable[[], Optional[float]],
+               required: bool) -> Optional[float]:
+        key = (self.name, field)
+        try:
+            value = fetch()
+            if value is None and required:
+                raise PrometheusUnavailable(f"No data for {self.name} {field}")
+        except Exception as e:
+            with _LAST_KNOWN_GOOD_LOCK:
+                last_value = _LAST_KNOWN_GOOD.get(key)
+            if last_value is None:
+                if isinstance(e, PrometheusUnavailable):
+                    raise
+                raise PrometheusUnavailable(
+                    f"Unable to get {self.name} {field}") from e
+            sys.stderr.write(f"Using last known {self.name} {field}: "
+                             f"{e!r}\n")
+            self.stale.append(field)
+            return last_value
+
+        if value is not None:
+            with _LAST_KNOWN_GOOD_LOCK:
+                _LAST_KNOWN_GOOD[key] = value
+        return value
@@ -0,0 +1,180 @@
+import base64
+from collections import defaultdict, deque
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, IO, List, Optional, Tuple, \
+                   TypeVar
+
+import requests
+
+from .tracing import span
+
+T = TypeVar("T")
+
+# Upstream interactions are written to SMARTDISPLAY_RECORD, or read back from
+# SMARTDISPLAY_REPLAY instead of contacting the real upstreams. Paths ending
+# in .gz are compressed. SMARTDISPLAY_REPLAY_SPEED scales the recorded delays,
+# with 0 replaying without any delay at all.
+RECORD_ENV = "SMARTDISPLAY_RECORD"
+REPLAY_ENV = "SMARTDISPLAY_REPLAY"
+REPLAY_SPEED_ENV = "SMARTDISPLAY_REPLAY_SPEED"
+
+PROMETHEUS = "prometheus"
+DARWIN_BOARD = "darwin_board"
+DARWIN_SERVICE = "darwin_service"
+SONOS_EVENT = "sonos_event"
+ALBUM_ART = "album_art"
+
+
+class ReplayedError(requests.exceptions.ConnectionError):
+    pass
+
+
+class ReplayMissing(ReplayedError):
+    pass
+
+
+def _open_for_append(path: str) -> IO[str]:
+    if path.endswith(".gz"):
+        return gzip.open(path, "at", encoding="utf8")
+    return open(path, "a", encoding="utf8")
+
+
+def _open_for_read(path: str) -> IO[str]:
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf8")
+    return open(path, "r", encoding="utf8")
+
+
+def _fuzzy_key(key: str) -> str:
+    # Queries containing times, such as the minutes since midnight, won't
+    # match exactly when replayed later.
+    return re.sub(r"\d+", "#", key)
+
+
+class Recorder:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._file = _open_for_append(path)
+        print(f"Recording upstream traffic to {path}")
+
+    def write(self,
+              kind: str,
+              key: str,
+              value: Any,
+              latency: float,
+              error: Optional[str] = None) -> None:
+        entry: Dict[str, Any] = {
+            "t": round(time.time() - self._start, 3),
+            "kind": kind,
+            "key": key,
+            "latency": round(latency, 4),
+        }
+        if error is not None:
+            entry["error"] = error
+        else:
+            entry["value"] = value
+        line = json.dumps(entry, separators=(",", ":"), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+
+class Replayer:
+    def __init__(self, path: str, speed: float) -> None:
+        self.path = path
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._responses: Dict[Tuple[str, str], Deque[Dict[str, Any]]] = \
+            defaultdict(deque)
+        self._fuzzy: Dict[Tuple[str, str], Deque[Dict[str, Any]]] = \
+            defaultdict(deque)
+        self._events: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+
+        with _open_for_read(path) as f:
+            for line in f:
+                if line.strip() == "":
+                    continue
+                entry = json.loads(line)
+                if entry["kind"] == SONOS_EVENT:
+                    self._events[entry["kind"]].append(entry)
+                    continue
+                self._responses[(entry["kind"], entry["key"])].append(entry)
+                self._fuzzy[(entry["kind"], _fuzzy_key(entry["key"]))] \
+                    .append(entry)
+        print(f"Replaying upstream traffic from {path} at {speed}x")
+
+    def respond(self, kind: str, key: str) -> Any:
+        with self._lock:
+            entries = self._responses.get((kind, key))
+            if entries is None:
+                entries = self._fuzzy.get((kind, _fuzzy_key(key)))
+            if entries is None:
+                raise ReplayMissing(f"No recorded {kind} for {key}")
+            # The last recording for a key is repeated forever.
+            entry = entries.popleft() if len(entries) > 1 else entries[0]
+
+        self.sleep(entry["latency"])
+        if "error" in entry:
+            raise ReplayedError(entry["error"])
+        return entry["value"]
+
+    def events(self, kind: str) -> List[Dict[str, Any]]:
+        return sorted(self._events[kind], key=lambda entry: entry["t"])
+
+    def sleep(self, seconds: float) -> None:
+        if self.speed > 0 and seconds > 0:
+            time.sleep(seconds / self.speed)
+
+
+RECORDER: Optional[Recorder] = \
+    Recorder(os.environ[RECORD_ENV]) if os.environ.get(RECORD_ENV) else None
+REPLAYER: Optional[Replayer] = \
+    Replayer(os.environ[REPLAY_ENV],
+             float(os.environ.get(REPLAY_SPEED_ENV, "1"))) \
+    if os.environ.get(REPLAY_ENV) else None
+
+
+def upstream_call(kind: str,
+                  key: str,
+                  func: Callable[[], T],
+                  encode: Callable[[T], Any] = lambda value: value,
+                  decode: Callable[[Any], T] = lambda value: value) -> T:
+    with span(kind, key):
+        if REPLAYER is not None:
+            return decode(REPLAYER.respond(kind, key))
+        if RECORDER is None:
+            return func()
+
+        start = time.monotonic()
+        try:
+            value = func()
+        except Exception as e:
+            RECORDER.write(kind, key, None, time.monotonic() - start,
+                           repr(e))
+            raise
+        RECORDER.write(kind, key, encode(value), time.monotonic() - start)
+        return value
+
+
+def record_event(kind: str, key: str, value: Any) -> None:
+    if RECORDER is not None:
+        RECORDER.write(kind, key, value, 0.0)
+
+
+def encode_bytes(value: Optional[bytes]) -> Optional[str]:
+    if value is None:
+        return None
+    return base64.b64encode(value).decode("ascii")
+
+
+def decode_bytes(value: Optional[str]) -> Optional[bytes]:
+    if value is None:
+        return None
+    return base64.b64decode(value)
@@ -0,0 +1,32 @@
+from typing import Any, Optional
+
+# How much the interval changes by after each refresh.
+GROWTH = 1.5
+BACKOFF = 0.5
+
+_UNSET = object()
+
+
+# Learns how often a source's data really changes. Each refresh that finds
+# the same data as last time waits longer before the next one, each that
+# finds new data waits less, so the interval settles around the rate the
+# data changes at.
+class AdaptiveInterval:
+    def __init__(self, minimum: float, maximum: float) -> None:
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = minimum
+        self._value: Any = _UNSET
+
+    def update(self, value: Any, hint: Optional[float] = None) -> float:
+        # A hint is what the source knows about its next change, it wins
+        # over what has been learnt.
+        if self._value is not _UNSET:
+            if value == self._value:
+                self.interval = min(self.maximum, self.interval * GROWTH)
+            else:
+                self.interval = max(self.minimum, self.interval * BACKOFF)
+        self._value = value
+        if hint is not None:
+            return max(self.minimum, min(self.maximum, hint))
+        return self.interval
@@ -0,0 +1,79 @@
+import hashlib
+import json
+from typing import Any, List, Optional, Tuple
+
+import msgpack  # type:ignore
+
+from .cache import CACHES, MISSING, MiB
+
+JSON = "application/json"
+# Displays that send this in Accept get MessagePack instead, which is smaller
+# and much cheaper to parse on a microcontroller. Floats are packed as single
+# precision, which is all MicroPython has anyway.
+MSGPACK = "application/msgpack"
+MSGPACK_TYPES = (MSGPACK, "application/x-msgpack")
+
+
+class EncodedResponse:
+    def __init__(self, body: bytes, content_type: str) -> None:
+        self.body = body
+        self.content_type = content_type
+        self.length = str(len(body))
+        self.etag = f'"{hashlib.sha1(body).hexdigest()}"'
+
+
+def encode(data: Any, content_type: str = JSON) -> EncodedResponse:
+    if content_type == MSGPACK:
+        return EncodedResponse(msgpack.packb(data, use_single_float=True),
+                               MSGPACK)
+    return EncodedResponse(json.dumps(data).encode("utf8"), JSON)
+
+
+def negotiate(accept: Optional[str]) -> str:
+    # JSON unless MessagePack is asked for by name.
+    if accept is None:
+        return JSON
+    for media_range in accept.split(","):
+        params = [param.strip() for param in media_range.split(";")]
+        if params[0].lower() in MSGPACK_TYPES and _quality(params[1:]) > 0:
+            return MSGPACK
+    return JSON
+
+
+def _quality(params: List[str]) -> float:
+    for param in params:
+        name, _, value = param.partition("=")
+        if name.strip().lower() == "q":
+            try:
+                return float(value.strip())
+            except ValueError:
+                return 0.0
+    return 1.0
+
+
+# Panels return the same objects until their data changes, so the encoded
+# response is looked up by the identity of what is being encoded. Dicts built
+# per request from cached values, such as the trains response, are looked
+# up by the identity of their keys and values instead.
+class ResponseCache:
+    def __init__(self, budget: int = 1 * MiB) -> None:
+        # The objects are kept alongside so their ids can't be reused.
+        self.region = CACHES.region(
+            "responses", budget, sizeof=lambda entry: len(entry[1].body))
+
+    def encode(self, data: Any, content_type: str = JSON) -> EncodedResponse:
+        identity = _identity(data)
+        key = (content_type,) + tuple(id(item) for item in identity)
+        entry = self.region.get(key)
+        if entry is not MISSING:
+            return entry[1]
+
+        encoded = encode(data, content_type)
+        self.region.put(key, (identity, encoded))
+        return encoded
+
+
+def _identity(data: Any) -> Tuple[Any, ...]:
+    if isinstance(data, dict):
+        return tuple(item for pair in data.items() for item in pair)
+    return (data,)
@@ -1,21 +1,31 @@
 from datetime import date, datetime, tzinfo
 import http.server
-import json
 from io import BytesIO
-from typing import Any, List
+import os
+from typing import Any, Dict, List, Optional
 from urllib.parse import urlparse, parse_qs
-import sys
 import traceback
 from zoneinfo import ZoneInfo
 
-from sentry_sdk import capture_exception, capture_message  # type:ignore
+from sentry_sdk import capture_exception  # type:ignore
 
+from .cache import CACHES
 from .current_weather import get_current_weather, \
                              get_current_weather_last_update
-from .image import load_image
+from .display_session import DisplaySession, SessionRegistry
+from .error_aggregator import ErrorAggregator
+from .image import is_raw_image, load_animation, load_image, \
+                   raw_image_path
+from .log_buffer import LogBuffer
+from .panel_cache import PANEL_CACHE, is_restored
+from .prefetch import Prefetcher
+from .prometheus import last_known_good, restore_last_known_good
+from .response_cache import EncodedResponse, ResponseCache, encode, \
+                            negotiate
+from .snapshot import SNAPSHOT_ENV, Snapshot
 from .sonos import SonosHandler
-from .trains import get_trains_message, get_trains_from_london, \
-                    get_trains_to_london
+from .trains import TRAINS, get_trains, get_trains_message
+from .tracing import trace
 from .house_temperature import get_house_temperature
 from .solar import get_current_solar, is_solar_valid
 from .water_gas import get_water_gas
@@ -23,6 +33,31 @@ from .air_quality import get_air_quality
 
 SONOS = SonosHandler()
 
+SNAPSHOT = Snapshot(os.environ.get(SNAPSHOT_ENV))
+SNAPSHOT.register("prometheus", last_known_good, restore_last_known_good)
+SNAPSHOT.register("panels", PANEL_CACHE.snapshot, PANEL_CACHE.restore)
+SNAPSHOT.register("trains", TRAINS.snapshot, TRAINS.restore)
+SNAPSHOT.register("sonos", SONOS.snapshot, SONOS.restore)
+SNAPSHOT.load()
+SNAPSHOT.start()
+
+SESSIONS = SessionRegistry()
+LOGS = LogBuffer()
+ERRORS = ErrorAggregator()
+PREFETCH = Prefetcher()
+RESPONSES = ResponseCache()
+
+# Seconds an idle keep-alive connection is held open before it is closed.
+KEEP_ALIVE_TIMEOUT = 30
+
+
+def following_screen(screens: List[str], current: str) -> str:
+    idx = [idx for (screen, idx) in zip(screens, range(len(screens)))
+           if screen == current]
+    if len(idx) == 0:
+        return screens[0]
+    return screens[(idx[0] + 1) % len(screens)]
+
 
 def handle_error(func):
     def r(self, *args, **kwargs):
@@ -32,31 +67,54 @@ def handle_error(func):
             traceback.print_exception(e)
             capture_exception(e)
 
-            self.send_response(500)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-
-            self.wfile.write(f"Exception Occurred.\n".encode("utf8"))
+            # The response may have been partially written, so don't try to
+            # reuse the connection after an error.
+            self.close_connection = True
+            self.send_text(500, "Exception Occurred.\n")
     return r
 
 
 class SmartDisplayHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+    # Headers and body are buffered and sent together once the request has
+    # been handled, so there's nothing for Nagle's algorithm to hold back.
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
     @handle_error
     def do_GET(self) -> None:
+        with trace(f"GET {urlparse(self.path).path}"):
+            self.handle_get()
+
+    def handle_get(self) -> None:
         data: Any
         if self.path.startswith("/next_screen"):
             data = self.next_screen()
+        elif self.path.startswith("/logs"):
+            data = self.logs()
+            if data is None:
+                self.send_text(400, "since must be a sequence number\n")
+                return
+        elif self.path.startswith("/cache"):
+            data = CACHES.stats()
         elif self.path.startswith("/sonos/art"):
             query_components = parse_qs(urlparse(self.path).query)
             header = query_components.get("header", ["0"])[0] == "1"
-            self.image(SONOS.get_current_album_art(header))
+            if query_components.get("animated", ["0"])[0] == "1":
+                self.image(SONOS.get_current_album_art_animation())
+            else:
+                self.image(SONOS.get_current_album_art(header))
             return
         elif self.path.startswith("/sonos"):
             data = self.sonos_data()
         elif self.path.startswith("/trains_to_london"):
-            data = self.trains_to_london()
+            data = self.trains("to_london")
         elif self.path.startswith("/trains_from_london"):
-            data = self.trains_from_london()
+            data = self.trains("from_london")
+        elif self.path.startswith("/trains?"):
+            query_components = parse_qs(urlparse(self.path).query)
+            data = self.trains(query_components.get("route", [None])[0])
         elif self.path.startswith("/house_temperature"):
             data = get_house_temperature()
         elif self.path.startswith("/current_weather"):
@@ -70,7 +128,12 @@ class SmartDisplayHandler(http.server.BaseHTTPRequestHandler):
         elif self.path.startswith("/image"):
             query_components = parse_qs(urlparse(self.path).query)
             file_name = query_components["file"][0]
-            self.image(load_image(file_name))
+            if is_raw_image(file_name):
+                self.image_file(raw_image_path(file_name))
+            elif query_components.get("animated", ["0"])[0] == "1":
+                self.image(load_animation(file_name))
+            else:
+                self.image(load_image(file_name))
             return
         else:
             self.return404()
@@ -80,21 +143,44 @@ class SmartDisplayHandler(http.server.BaseHTTPRequestHandler):
             self.return404()
             return
 
-        json_data = json.dumps(data).encode("utf8")
+        content_type = negotiate(self.headers.get("Accept"))
+        # Logs and stats are different every time, so aren't worth keeping.
+        if self.path.startswith("/logs") or self.path.startswith("/cache"):
+            self.send_data(encode(data, content_type))
+        else:
+            self.send_data(RESPONSES.encode(data, content_type))
+
+    def send_data(self, response: EncodedResponse) -> None:
+        if self.headers.get("If-None-Match") == response.etag:
+            self.send_response(304)
+            self.send_header("ETag", response.etag)
+            self.send_header("Vary", "Accept")
+            self.end_headers()
+            return
 
         self.send_response(200)
-        self.send_header("Content-type", "application/json")
-        self.send_header("Content-length", str(len(json_data)))
+        self.send_header("Content-type", response.content_type)
+        self.send_header("Content-length", response.length)
+        self.send_header("ETag", response.etag)
+        self.send_header("Vary", "Accept")
         self.end_headers()
 
-        self.wfile.write(json_data)
+        self.wfile.write(response.body)
 
     def return404(self) -> Any:
-        self.send_response(404)
+        self.send_text(404, f"Page {self.path} not found")
+
+    def send_text(self, code: int, text: str) -> None:
+        body = text.encode("utf8")
+
+        self.send_response(code)
         self.send_header("Content-type", "text/plain")
+        self.send_header("Content-length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
         self.end_headers()
 
-        self.wfile.write(f"Page {self.path} not found".encode("utf8"))
+        self.wfile.write(body)
 
     @handle_error
     def do_POST(self) -> None:
@@ -106,6 +192,10 @@ class SmartDisplayHandler(http.server.BaseHTTPRequestHandler):
             self.log(data.getvalue().decode("utf8"))
         elif self.path.startswith("/error"):
             self.error(data.getvalue().decode("utf8"))
+        elif self.path.startswith("/cache/invalidate"):
+            if not self.invalidate():
+                self.return404()
+                return
         else:
             self.return404()
             return
@@ -116,23 +206,42 @@ class SmartDisplayHandler(http.server.BaseHTTPRequestHandler):
     def next_screen(self) -> str:
         query_components = parse_qs(urlparse(self.path).query)
         current = query_components["current"][0]
+        session = self.session()
+        session.screen_requested()
 
         if current in ("sonos", "sonos_quick"):
-            current = SONOS.get_last_screen()
-
-        if SONOS.has_track_changed():
-            SONOS.set_last_screen(current)
-            return "sonos"
-        if SONOS.show_quick():
-            SONOS.set_last_screen(current)
-            return "sonos_quick"
+            current = session.get_last_screen()
 
         screens = self.get_screens()
-        idx = [idx for (screen, idx) in zip(screens, range(len(screens)))
-               if screen == current]
-        if len(idx) == 0:
-            return screens[0]
-        return screens[(idx[0] + 1) % len(screens)]
+        if session.has_track_changed(SONOS.track_info):
+            session.set_last_screen(current)
+            screen = "sonos"
+        elif session.show_quick():
+            session.set_last_screen(current)
+            screen = "sonos_quick"
+        else:
+            screen = following_screen(screens, current)
+
+        # After Sonos the display goes back to where it left the rotation.
+        if session.screen_duration is not None:
+            upcoming = following_screen(
+                screens,
+                current if screen in ("sonos", "sonos_quick") else screen)
+            PREFETCH.schedule(session.display_id,
+                              upcoming,
+                              session.screen_duration)
+        return screen
+
+    def display_id(self) -> str:
+        query_components = parse_qs(urlparse(self.path).query)
+        display_id = query_components.get(
+            "display", [self.headers.get("X-Display-Id")])[0]
+        if display_id is None:
+            return self.client_address[0]
+        return display_id
+
+    def session(self) -> DisplaySession:
+        return SESSIONS.get(self.display_id())
 
     def get_screens(self) -> List[str]:
         now = datetime.now(tz=ZoneInfo("Europe/London"))
@@ -173,20 +282,19 @@ class SmartDisplayHandler(http.server.BaseHTTPRequestHandler):
         track = SONOS.track_info
         if track is None:
             return None
-        return {
+        data = {
             "artist": track.artist,
             "album": track.album,
             "track": track.title,
             "album_art": SONOS.get_current_album_art() is not None
         }
+        if track.stale:
+            data["stale"] = ["artist", "album", "track"]
+        return data
 
-    def image(self, image_data) -> Any:
+    def image(self, image_data: Optional[bytes | memoryview]) -> Any:
         if image_data is None:
-            self.send_response(404)
-            self.send_header("Content-type", "text/plain")
-            self.send_header("Content-length", "4")
-            self.end_headers()
-            self.wfile.write("404\n".encode("utf8"))
+            self.send_text(404, "404\n")
             return
         self.send_response(200)
         self.send_header("Content-type", "application/octet-stream")
@@ -195,25 +303,65 @@ class SmartDisplayHandler(http.server.BaseHTTPRequestHandler):
 
         self.wfile.write(image_data)
 
-    def trains_to_london(self) -> Any:
-        return {
-            "msg": get_trains_message(),
-            "trains": get_trains_to_london()
-        }
+    def image_file(self, path: Optional[str]) -> Any:
+        if path is None or not os.path.isfile(path):
+            self.send_text(404, "404\n")
+            return
+        with open(path, "rb") as f:
+            self.send_response(200)
+            self.send_header("Content-type", "application/octet-stream")
+            self.send_header("Content-length",
+                             str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
 
-    def trains_from_london(self) -> Any:
-        return {
-            "msg": get_trains_message(),
-            "trains": get_trains_from_london()
+            # Uses os.sendfile, so the file is never copied into userspace.
+            self.wfile.flush()
+            self.connection.sendfile(f)
+
+    def trains(self, route: Optional[str]) -> Any:
+        display = self.display_id()
+        if route is None or route not in TRAINS.routes:
+            return None
+        # Checked first, so a refresh landing in between can't hide it.
+        stale = [name for name, func in (("msg", get_trains_message),
+                                         ("trains", get_trains))
+                 if is_restored(func, route, display)]
+        data: Dict[str, Any] = {
+            "msg": get_trains_message(route, display),
+            "trains": get_trains(route, display)
         }
+        if TRAINS.route(route, display).board.stale:
+            stale = ["msg", "trains"]
+        if len(stale) > 0:
+            data["stale"] = stale
+        return data
 
     def log(self, data: str) -> Any:
-        sys.stdout.write(data)
-        sys.stdout.flush()
+        LOGS.append(self.display_id(), data)
         return {}
 
+    def logs(self) -> Any:
+        query_components = parse_qs(urlparse(self.path).query)
+        try:
+            since = int(query_components.get("since", ["0"])[0])
+        except ValueError:
+            return None
+        return LOGS.since(since)
+
+    def invalidate(self) -> bool:
+        # Empties one region, or all of them without a region parameter.
+        query_components = parse_qs(urlparse(self.path).query)
+        name = query_components.get("region", [None])[0]
+        if name is None:
+            for region in CACHES:
+                region.invalidate()
+            return True
+        named = CACHES.get(name)
+        if named is None:
+            return False
+        named.invalidate()
+        return True
+
     def error(self, data: str) -> Any:
-        capture_message(data)
-        sys.stderr.write(data)
-        sys.stderr.flush()
+        ERRORS.add(self.display_id(), data)
         return {}
@@ -0,0 +1,79 @@
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# The last known panel data is saved to SMARTDISPLAY_SNAPSHOT and restored
+# from it on startup, so a restarted backend has something to show before
+# the upstreams answer.
+SNAPSHOT_ENV = "SMARTDISPLAY_SNAPSHOT"
+SNAPSHOT_INTERVAL = 60
+
+
+class Snapshot:
+    def __init__(self, path: Optional[str]) -> None:
+        self.path = path
+        self._parts: Dict[str, Tuple[Callable[[], Any],
+                                     Callable[[Any], None]]] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def register(self,
+                 name: str,
+                 save: Callable[[], Any],
+                 restore: Callable[[Any], None]) -> None:
+        self._parts[name] = (save, restore)
+
+    def load(self) -> None:
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            sys.stderr.write(f"Unable to read snapshot {self.path}: {e!r}\n")
+            return
+
+        print(f"Restoring snapshot from {self.path}, "
+              f"{time.time() - data['time']:.0f}s old")
+        for name, (_, restore) in self._parts.items():
+            if name not in data["parts"]:
+                continue
+            try:
+                restore(data["parts"][name])
+            except Exception:
+                sys.stderr.write(f"Unable to restore {name} from snapshot:\n")
+                traceback.print_exc(file=sys.stderr)
+                sys.stderr.flush()
+
+    def start(self) -> None:
+        if self.path is None or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._saver)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self) -> None:
+        assert self.path is not None
+        data = {
+            "time": time.time(),
+            "parts": {name: save() for name, (save, _)
+                      in self._parts.items()}
+        }
+        # Written alongside and renamed, so a crash never leaves half a file.
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf8") as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.path)
+
+    def _saver(self) -> None:
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL)
+            try:
+                self.save()
+            except Exception:
+                sys.stderr.write("Unable to save snapshot:\n")
+                traceback.print_exc(file=sys.stderr)
+                sys.stderr.flush()
@@ -1,72 +1,86 @@
 from datetime import datetime, UTC
-import time
-from typing import Dict, Tuple
+from typing import Any, Dict, Optional
 
-from prometheus_api_client import PrometheusConnect  # type:ignore
+from .counters import IncrementalCounter
+from .panel_cache import panel_cache
+from .prometheus import Panel, PrometheusUnavailable
 
-IMPORT_QUERY = """
-increase(glowprom_import_cumulative_Wh{type="electric"}[24h])
-- on () sum(increase(teslamate_home_kwh_total[24h])) * 1000
-- on () increase(octopus_export[24h]) * 1000
-"""
+ELECTRIC_IMPORT = \
+    IncrementalCounter("glowprom_import_cumulative_Wh{type=\"electric\"}")
+ELECTRIC_EXPORT = IncrementalCounter("octopus_export")
+ELECTRIC_COST = IncrementalCounter("octopus_cost{type=\"electric\"}")
+ELECTRIC_FEED_IN = IncrementalCounter("octopus_feed_in{type=\"electric\"}")
+CAR_KWH = IncrementalCounter("teslamate_home_kwh_total")
+CAR_COST = IncrementalCounter("teslamate_home_cost_total", resets=False)
 
-CAR_QUERY = "increase(teslamate_home_kwh_total[24h]) * 1000"
+# With the panels producing nothing the rest of the panel barely moves.
+SOLAR_NIGHT_TTL = 300
 
-HOUSE_COST = """
-increase(octopus_cost{type="electric"}[24h])
-- on () sum(delta(teslamate_home_cost_total[24h]))
-- on () increase(octopus_feed_in{type="electric"}[24h])
-"""
 
-CAR_COST = "sum(delta(teslamate_home_cost_total[24h]))"
+def _night_hint(data: Dict[str, Any]) -> Optional[float]:
+    return SOLAR_NIGHT_TTL if data["pv_power"] == 0 else None
 
 
+@panel_cache(max_ttl=600, warm_start=False)
 def is_solar_valid() -> bool:
-    prom = PrometheusConnect(url="http://192.168.1.207:9090")
+    panel = Panel("solar_valid")
 
     try:
-        _get_metric(prom, "foxess_pvPower")
-    except IndexError:
+        return panel.optional_metric("pv_power", "foxess_pvPower") is not None
+    except PrometheusUnavailable:
         return False
-    return True
 
 
-def get_current_solar() -> Dict[str, float | str]:
-    prom = PrometheusConnect(url="http://192.168.1.207:9090")
+@panel_cache(max_ttl=SOLAR_NIGHT_TTL, hint=_night_hint)
+def get_current_solar() -> Dict[str, Any]:
+    panel = Panel("solar")
 
     time = datetime.now(tz=UTC).time()
     since_midnight = time.hour * 60 + time.minute
 
-    return {
-        "house_wh": _get_query(prom, IMPORT_QUERY),
-        "car_wh": _get_query(prom, CAR_QUERY),
-        "house_cost": _get_query(prom, HOUSE_COST),
-        "car_cost": _get_query(prom, CAR_COST),
-        "pv_power": _get_metric(prom, "foxess_pvPower"),
+    return panel.result({
+        "house_wh": panel.value("house_wh", _house_wh),
+        "car_wh": panel.value("car_wh", _car_wh),
+        "house_cost": panel.value("house_cost", _house_cost),
+        "car_cost": panel.value("car_cost", CAR_COST.value),
+        "pv_power": panel.metric("pv_power", "foxess_pvPower"),
         "pv_generation":
-            _get_query(prom,
-                       "increase(foxess_pv_generation_total"
-                       + f"[{since_midnight}m])"),
-        "battery": _get_metric(prom, "foxess_SoC"),
-        "house_load": _get_metric(prom, "foxess_loadsPower"),
-        "current_power": _get_metric(prom, "glowprom_power_W"),
+            panel.query("pv_generation",
+                        "increase(foxess_pv_generation_total"
+                        + f"[{since_midnight}m])"),
+        "battery": panel.metric("battery", "foxess_SoC"),
+        "house_load": panel.metric("house_load", "foxess_loadsPower"),
+        "current_power": panel.metric("current_power", "glowprom_power_W"),
         "battery_change":
-            _get_query(prom,
-                       "foxess_batChargePower - foxess_batDischargePower")
+            panel.query("battery_change",
+                        "foxess_batChargePower - foxess_batDischargePower")
             * 1000
-    }
+    })
 
 
-def _get_metric(prom: PrometheusConnect, metric: str) -> float:
-    data = prom.get_current_metric_value(metric_name=metric)
+def _house_wh() -> Optional[float]:
+    imported = ELECTRIC_IMPORT.value()
+    car = CAR_KWH.value()
+    exported = ELECTRIC_EXPORT.value()
+    if imported is None or car is None or exported is None:
+        return None
+    return imported - car * 1000 - exported * 1000
 
-    return float(data[0]["value"][1])
 
+def _car_wh() -> Optional[float]:
+    car = CAR_KWH.value()
+    if car is None:
+        return None
+    return car * 1000
 
-def _get_query(prom: PrometheusConnect, query: str) -> float:
-    data = prom.custom_query(query)
 
-    return float(data[0]["value"][1])
+def _house_cost() -> Optional[float]:
+    cost = ELECTRIC_COST.value()
+    car = CAR_COST.value()
+    feed_in = ELECTRIC_FEED_IN.value()
+    if cost is None or car is None or feed_in is None:
+        return None
+    return cost - car - feed_in
 
 
 if __name__ == "__main__":
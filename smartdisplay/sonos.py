@@ -1,24 +1,32 @@
 #!/usr/bin/python3
 
+from concurrent.futures import Future
 from datetime import datetime, UTC
-from functools import lru_cache
 import io
-import math
 import queue
-import struct
 import sys
 import threading
 import time
 import traceback
-from typing import Any, Dict, Optional, List
+from typing import Any, Callable, Dict, Optional, List, Tuple
 from xml.dom.minidom import parseString
 
-from PIL import Image
 import requests
 
 from sentry_sdk import capture_exception  # type:ignore
 import soco  # type: ignore
 
+from .cache import CACHES, MISSING, MiB, cached
+from .frames import Frame, decode_frames, encode_animation, with_header
+from .recorder import ALBUM_ART, REPLAYER, SONOS_EVENT, decode_bytes, \
+                      encode_bytes, record_event, upstream_call
+from .single_flight import SINGLE_FLIGHT, single_flight
+from .tracing import span, trace
+from .worker_pool import BoundedExecutor
+
+ART_POOL = BoundedExecutor("album-art")
+ART_CACHE = CACHES.region("album_art", 4 * MiB)
+
 # Apple Music
 # {'creator': 'Arcade Fire', 'stream_content': '', 'radio_show': '',
 #  'album_art_uri': '/getaa?s=1&u=xyz',
@@ -143,18 +151,20 @@ def sonos_watcher(device_name: str,
             try:
                 event = subscription.events.get(timeout=5)
 
-                if event.variables.get("transport_state", None) != "PLAYING":
-                    handler.track_info = None
-                    continue
+                transport_state = event.variables.get("transport_state", None)
+                meta_data = None
                 if "current_track_meta_data" in event.variables \
                         and event.variables["current_track_meta_data"] != "":
-                    meta_data = event.variables["current_track_meta_data"]
-                    print("sonos", meta_data.to_dict())
-                    track_info = process_event_track_metadata(
-                        meta_data.to_dict(),
-                        devices["Kitchen"])
-                    handler.track_info = track_info
-                    print("sonos", track_info)
+                    meta_data = \
+                        event.variables["current_track_meta_data"].to_dict()
+                ip_address = devices["Kitchen"].ip_address
+
+                record_event(SONOS_EVENT, device_name, {
+                    "transport_state": transport_state,
+                    "meta_data": meta_data,
+                    "ip_address": ip_address
+                })
+                process_event(handler, transport_state, meta_data, ip_address)
             except queue.Empty:
                 pass
     except Exception as e:
@@ -164,7 +174,7 @@ def sonos_watcher(device_name: str,
         capture_exception(e)
     finally:
         print(f"Sonos watcher for {device_name} is shutting down!")
-        handler.track_info = None
+        handler.set_track_info(None)
         if subscription is not None:
             try:
                 subscription.unsubscribe()
@@ -172,6 +182,38 @@ def sonos_watcher(device_name: str,
                 pass
 
 
+def replay_watcher(handler: "SonosHandler", terminator: Terminator) -> None:
+    assert REPLAYER is not None
+    last_time = 0.0
+    for entry in REPLAYER.events(SONOS_EVENT):
+        REPLAYER.sleep(entry["t"] - last_time)
+        last_time = entry["t"]
+        if terminator.is_terminated():
+            break
+        try:
+            process_event(handler,
+                          entry["value"]["transport_state"],
+                          entry["value"]["meta_data"],
+                          entry["value"]["ip_address"])
+        except Exception as e:
+            sys.stderr.write("Error replaying sonos event:\n")
+            traceback.print_exc(file=sys.stderr)
+            sys.stderr.flush()
+    print("Sonos replay finished")
+
+
+def process_event(handler: "SonosHandler",
+                  transport_state: Optional[str],
+                  meta_data: Optional[Dict[str, Any]],
+                  ip_address: str) -> None:
+    if transport_state != "PLAYING":
+        handler.set_track_info(None)
+        return
+    if meta_data is not None:
+        print("sonos", meta_data)
+        handler.load_track_info(meta_data, ip_address)
+
+
 def stream_content_split(stream_content: str, key: str) -> str:
     if key in stream_content:
         return stream_content.split(key)[1].split("|")[0]
@@ -179,14 +221,14 @@ def stream_content_split(stream_content: str, key: str) -> str:
 
 
 def process_event_track_metadata(metadata: Dict[str, Any],
-                                 device: Any) -> Optional["TrackInfo"]:
+                                 sonos_ip: str) -> Optional["TrackInfo"]:
     if "creator" in metadata and len(metadata["creator"]) > 0:
         return TrackInfo({
             "artist": metadata["creator"],
             "album": metadata.get("album", ""),
             "title": metadata.get("title", ""),
             "album_art": metadata.get("album_art_uri", "")
-        }, device.ip_address)
+        }, sonos_ip)
     elif "stream_content" in metadata and len(metadata["stream_content"]) > 0:
         return TrackInfo({
             "artist": stream_content_split(
@@ -199,14 +241,14 @@ def process_event_track_metadata(metadata: Dict[str, Any],
                 metadata["stream_content"],
                 "|TITLE "),
             "album_art": metadata.get("album_art_uri", "")
-        }, device.ip_address)
+        }, sonos_ip)
     elif "title" in metadata and len(metadata["title"]) > 0:
         return TrackInfo({
             "artist": "",
             "album": "",
             "title": metadata["title"],
             "album_art": metadata.get("album_art_uri", "")
-        }, device.ip_address)
+        }, sonos_ip)
     else:
         sys.stderr.write("Unknown metadata format:\n")
         sys.stderr.write(repr(metadata) + "\n")
@@ -223,27 +265,49 @@ class TrackInfo:
         if not self.album_art.startswith("http"):
             self.album_art = f"http://{sonos_uri}:1400{self.album_art}"
 
+        self.album_art_header: Optional[memoryview] = None
+        self.album_art_image: Optional[memoryview] = None
+        # Few displays ask for the animation, so it is encoded on first use.
+        self.album_art_frames: Optional[List[Frame]] = None
+        # Restored from a snapshot rather than reported by the speaker.
+        self.stale = False
+
         if self.album_art is not None and len(self.album_art) > 0:
             try:
-                self.album_art_header: Optional[bytes] = \
-                    get_album_art(self.album_art, True)
-                self.album_art_image: Optional[bytes] = \
-                    get_album_art(self.album_art, False)
+                frames = get_album_art_frames(self.album_art)
             except requests.exceptions.HTTPError as e:
                 sys.stderr.write(
                     f"Got error {e.response.status_code} "
                     f"accessing {self.album_art}.")
-                self.album_art_header = None
-                self.album_art_image = None
+                frames = None
             except requests.exceptions.ConnectionError as e:
                 sys.stderr.write("Error loading Album Art\n")
                 sys.stderr.write(repr(e))
-                self.album_art_header = None
-                self.album_art_image = None
+                frames = None
+            if frames is not None:
+                self.album_art_header = with_header(frames[0][0])
+                self.album_art_image = frames[0][0]
+                self.album_art_frames = frames
         else:
             print("no album art url :-(")
-            self.album_art_header = None
-            self.album_art_image = None
+
+    def album_art_animation(self) -> Optional[bytes]:
+        frames = self.album_art_frames
+        if frames is None:
+            return None
+        key = ("animation", self.album_art)
+        animation = ART_CACHE.get(key)
+        if animation is MISSING:
+            animation = SINGLE_FLIGHT.do(
+                key, lambda: self._encode_animation(key, frames))
+        return animation
+
+    def _encode_animation(self, key: Tuple[str, str], frames: List[Frame]
+                          ) -> bytes:
+        with span("image.encode", self.album_art):
+            animation = encode_animation(frames)
+        ART_CACHE.put(key, animation)
+        return animation
 
     def __eq__(self, other: object) -> bool:
         if other is None:
@@ -263,14 +327,16 @@ class TrackInfo:
 
 class SonosHandler:
     def __init__(self) -> None:
-        self._last_track_info: Optional[TrackInfo] = None
         self.track_info: Optional[TrackInfo] = None
-        self.last_screen = "sonos"
-        self._last_display_time: Optional[datetime] = None
+
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._pending: Optional[Future[None]] = None
 
         self._terminator = Terminator("TopologyWatcher")
         print("starting sonos watcher")
-        self._thread = threading.Thread(target=topology_watcher,
+        watcher = topology_watcher if REPLAYER is None else replay_watcher
+        self._thread = threading.Thread(target=watcher,
                                         args=(self, self._terminator,))
         self._thread.daemon = True
         self._thread.start()
@@ -281,48 +347,115 @@ class SonosHandler:
         if self._thread.is_alive():
             self._thread.join(timeout=5)
 
-    def has_track_changed(self) -> bool:
-        if self.track_info is None:
-            self.last_display_time = None
-            self._last_track_info = None
-            return False
-        if self._last_track_info is None \
-                or self.track_info != self._last_track_info:
-            self._last_track_info = self.track_info
-            self.last_display_time = datetime.now(UTC)
-            return True
-        gap = datetime.now(UTC) - self.track_info.created
-        if abs(gap.total_seconds()) > 60 * 5:
-            self.track_info.created = datetime.now(UTC)
-            self.last_display_time = datetime.now(UTC)
-            return True
-        return False
-
-    def get_current_album_art(self, header: bool = False) -> Optional[bytes]:
+    def set_track_info(self, track_info: Optional[TrackInfo]) -> None:
+        with self._lock:
+            self._supersede()
+            self.track_info = track_info
+
+    def load_track_info(self,
+                        meta_data: Dict[str, Any],
+                        ip_address: str) -> None:
+        # Fetching and converting the art happens on ART_POOL, the track is
+        # only shown once its art is ready.
+        with self._lock:
+            generation = self._supersede()
+            self._submit(generation, lambda: process_event_track_metadata(
+                meta_data, ip_address))
+
+    def snapshot(self) -> Optional[Dict[str, Any]]:
+        track_info = self.track_info
+        if track_info is None:
+            return None
+        return {
+            "artist": track_info.artist,
+            "album": track_info.album,
+            "title": track_info.title,
+            "album_art": track_info.album_art
+        }
+
+    def restore(self, track: Optional[Dict[str, Any]]) -> None:
+        # Shown until the watcher reports what is really playing.
+        def load() -> TrackInfo:
+            track_info = TrackInfo(track, "")
+            track_info.stale = True
+            return track_info
+
+        with self._lock:
+            if track is None or self.track_info is not None \
+               or self._pending is not None:
+                return
+            self._submit(self._supersede(), load)
+
+    def _supersede(self) -> int:
+        # A newer event makes any track still being loaded irrelevant.
+        self._generation += 1
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        return self._generation
+
+    def _submit(self,
+                generation: int,
+                load: Callable[[], Optional[TrackInfo]]) -> None:
+        self._pending = ART_POOL.submit(self._load_track_info,
+                                        generation,
+                                        load)
+        if self._pending is None:
+            sys.stderr.write("Album art pool is full, dropping track\n")
+
+    def _load_track_info(self,
+                         generation: int,
+                         load: Callable[[], Optional[TrackInfo]]) -> None:
+        try:
+            with trace("album art"):
+                track_info = load()
+        except Exception as e:
+            sys.stderr.write("Error loading track info:\n")
+            traceback.print_exc(file=sys.stderr)
+            sys.stderr.flush()
+            capture_exception(e)
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self.track_info = track_info
+            self._pending = None
+        print("sonos", track_info)
+
+    def get_current_album_art(self,
+                              header: bool = False) -> Optional[memoryview]:
         if self.track_info is None:
             return None
         return self.track_info.album_art_header if header \
             else self.track_info.album_art_image
 
-    def set_last_screen(self, screen: str) -> None:
-        self.last_screen = screen
+    def get_current_album_art_animation(self) -> Optional[bytes]:
+        if self.track_info is None:
+            return None
+        return self.track_info.album_art_animation()
 
-    def get_last_screen(self) -> str:
-        return self.last_screen
 
-    def show_quick(self) -> bool:
-        if self._last_display_time is None:
-            return False
-        if (datetime.now(UTC) - self._last_display_time).total_seconds() \
-           > 2 * 60:
-            self._last_display_time = datetime.now(UTC)
-            return True
-        return False
+@cached(ART_CACHE)
+@single_flight
+def get_album_art_frames(art_uri: str) -> Optional[List[Frame]]:
+    sys.stderr.write(f"Getting album art {art_uri}\n")
+    data = upstream_call(ALBUM_ART,
+                         art_uri,
+                         lambda: download_album_art(art_uri),
+                         encode_bytes,
+                         decode_bytes)
+    if data is None:
+        return None
 
+    with span("image.decode", art_uri):
+        frames = decode_frames(io.BytesIO(data))
+    if frames is not None:
+        sys.stdout.write(f"Album art size: {len(frames[0][0])}, "
+                         f"{len(frames)} frames\n")
+    return frames
 
-@lru_cache(maxsize=20)
-def get_album_art(art_uri: str, header: bool) -> Optional[bytes]:
-    sys.stderr.write(f"Getting album art {art_uri}\n")
+
+def download_album_art(art_uri: str) -> Optional[bytes]:
     resp = requests.get(art_uri, stream=True, timeout=10)
     resp.raise_for_status()
     buffer = io.BytesIO()
@@ -331,53 +464,7 @@ def get_album_art(art_uri: str, header: bool) -> Optional[bytes]:
             buffer.write(chunk)
     except requests.exceptions.ChunkedEncodingError:
         return None
-    buffer.seek(0)
-
-    image_data: List[int] = []
-    if header:
-        image_data.extend(ord(c) for c in "I75v1")
-        image_data.append(64)
-        image_data.append(64)
-        image_data.append(3)
-        expected_size = 8 + 64 * 64 * 3
-    else:
-        expected_size = 64 * 64 * 3
-    with Image.open(buffer) as im:
-        try:
-            im.thumbnail((64, 64), Image.Resampling.NEAREST)
-        except OSError:
-            return None
-        xsize, ysize = im.size
-
-        xbefore, xafter, ybefore, yafter = 0, 0, 0, 0
-        if xsize < 64:
-            xbefore = math.floor((64 - xsize) / 2.0)
-            xafter = math.ceil((64 - xsize) / 2.0)
-        if ysize < 64:
-            ybefore = math.floor((64 - ysize) / 2.0)
-            yafter = math.ceil((64 - ysize) / 2.0)
-
-        if ybefore > 0:
-            image_data.extend([0, 0, 0] * 64 * ybefore)
-        for y in range(ysize):
-            if xbefore > 0:
-                image_data.extend([0, 0, 0] * xbefore)
-            for x in range(xsize):
-                pixel = im.getpixel((x, y))
-                if isinstance(pixel, int):
-                    r, g, b = pixel, pixel, pixel
-                elif len(pixel) == 3:
-                    r, g, b = pixel
-                else:
-                    raise ValueError(f"Got {len(pixel)} colour values.")
-
-                image_data.extend([r, g, b])
-            if xafter > 0:
-                image_data.extend([0, 0, 0] * xafter)
-        if yafter > 0:
-            image_data.extend([0, 0, 0] * 64 * yafter)
-    sys.stdout.write(f"Album art size: {len(image_data)}\n")
-    return struct.pack("B" * (expected_size), *image_data)
+    return buffer.getvalue()
 
 
 def xml_get_text(nodelist):
@@ -390,12 +477,14 @@ def xml_get_text(nodelist):
 
 if __name__ == "__main__":
     import time
+    from .display_session import DisplaySession
     handler = SonosHandler()
+    session = DisplaySession("console")
 
     while True:
-        if handler.has_track_changed():
+        if session.has_track_changed(handler.track_info):
             print("Track changed:", handler.track_info)
-        elif handler.show_quick():
+        elif session.show_quick():
             print("Show quick:", handler.track_info)
         else:
             print("No change:", handler.track_info)
@@ -0,0 +1,109 @@
+from contextlib import contextmanager
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+
+import sentry_sdk  # type:ignore
+
+# SMARTDISPLAY_TRACE_RATE is the fraction of requests traced, 0 by default.
+# Traces are written as JSON lines to the file named by
+# SMARTDISPLAY_TRACE_EXPORT, or sent to Sentry when it is "sentry".
+TRACE_RATE_ENV = "SMARTDISPLAY_TRACE_RATE"
+TRACE_EXPORT_ENV = "SMARTDISPLAY_TRACE_EXPORT"
+SENTRY = "sentry"
+
+
+class Trace:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.time = time.time()
+        self.start = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.depth = 0
+
+
+class Tracer:
+    def __init__(self, rate: float, export: Optional[str]) -> None:
+        self.rate = rate if export is not None else 0.0
+        self.export = export
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._file = None
+        if export is not None and export != SENTRY and self.rate > 0:
+            self._file = open(export, "a", encoding="utf8")
+            print(f"Tracing {self.rate:.0%} of requests to {export}")
+
+    @contextmanager
+    def trace(self, name: str) -> Iterator[None]:
+        # Requests are sampled as a whole, so a trace is never missing spans.
+        if self.rate <= 0 or random.random() >= self.rate \
+           or getattr(self._local, "trace", None) is not None:
+            yield
+            return
+
+        trace = Trace(name)
+        self._local.trace = trace
+        try:
+            if self.export == SENTRY:
+                with sentry_sdk.start_transaction(op="smartdisplay",
+                                                  name=name,
+                                                  sampled=True):
+                    yield
+            else:
+                yield
+        finally:
+            self._local.trace = None
+            if self._file is not None:
+                self._write(trace, time.perf_counter() - trace.start)
+
+    @contextmanager
+    def span(self, op: str, description: str) -> Iterator[None]:
+        trace: Optional[Trace] = getattr(self._local, "trace", None)
+        if trace is None:
+            yield
+            return
+
+        start = time.perf_counter()
+        trace.depth += 1
+        try:
+            if self.export == SENTRY:
+                with sentry_sdk.start_span(op=op, name=description):
+                    yield
+            else:
+                yield
+        finally:
+            trace.depth -= 1
+            trace.spans.append({
+                "op": op,
+                "description": description,
+                "depth": trace.depth,
+                "start": round(start - trace.start, 4),
+                "duration": round(time.perf_counter() - start, 4),
+            })
+
+    def _write(self, trace: Trace, duration: float) -> None:
+        assert self._file is not None
+        line = json.dumps({
+            "name": trace.name,
+            "time": round(trace.time, 3),
+            "duration": round(duration, 4),
+            "spans": sorted(trace.spans, key=lambda span: span["start"]),
+        }, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+
+TRACER = Tracer(float(os.environ.get(TRACE_RATE_ENV, "0")),
+                os.environ.get(TRACE_EXPORT_ENV))
+
+
+def trace(name: str) -> ContextManager[None]:
+    return TRACER.trace(name)
+
+
+def span(op: str, description: str) -> ContextManager[None]:
+    return TRACER.span(op, description)
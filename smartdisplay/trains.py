@@ -1,104 +1,370 @@
 from datetime import datetime
+import json
+import os
 import re
-from typing import Dict, List, Optional
+import sys
+import threading
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo
 
-from nredarwin.webservice import DarwinLdbSession, StationBoard  # type:ignore
+from nredarwin.webservice import DarwinLdbSession  # type:ignore
 
-DARWIN = DarwinLdbSession(
-    wsdl="https://lite.realtime.nationalrail.co.uk/"
-         + "OpenLDBWS/wsdl.aspx?ver=2021-11-01")
+from .cache import CACHES, MISSING, MiB
+from .panel_cache import PANEL_TTL, panel_cache
+from .recorder import DARWIN_BOARD, DARWIN_SERVICE, upstream_call
+from .refresh import AdaptiveInterval
+from .single_flight import SINGLE_FLIGHT
 
-NORTH_STATIONS = set([
+DARWIN_WSDL = "https://lite.realtime.nationalrail.co.uk/" \
+              + "OpenLDBWS/wsdl.aspx?ver=2021-11-01"
+
+_DARWIN: Optional[DarwinLdbSession] = None
+_DARWIN_LOCK = threading.Lock()
+
+# Boards and service details are kept as plain dicts of the fields we use,
+# so they can be recorded and replayed.
+Board = Dict[str, Any]
+
+NORTH_STATIONS = [
     "Royston",
     "Stevenage",
     "Cambridge",
     "Peterborough",
     "Letchworth Garden City"
-])
+]
 
-SOUTH_STATIONS = set([
+SOUTH_STATIONS = [
     "Hatfield", "Welwyn Green", "Brookmans Park",
     "Potters Bar", "Hadley Wood", "New Barnet",
     "Oakleigh Park", "New Southgate", "Alexandra Palace",
     "Harringay", "Hornsey", "Finsbury Park", "London Kings Cross",
     "Old Street", "Moorgate", "Sevenoaks"
-])
+]
+
+# Boards are refreshed somewhere between these, more often while they keep
+# changing and always at the fastest rate close to a train being due.
+DEFAULT_REFRESH = 300
+DEFAULT_MIN_REFRESH = 60
+NEAR_DEPARTURE = 10 * 60
+
+BOARDS = CACHES.region("train_boards", 1 * MiB)
+
+# SMARTDISPLAY_TRAINS names a JSON file replacing the default routes, in the
+# same form as DEFAULT_CONFIG. The optional "displays" section maps a display
+# ID to overrides of which route it is shown for a route name, for example
+# {"office": {"to_london": "hitchin_to_london"}}. A route may also set the
+# "refresh" and "min_refresh" bounds of its board in seconds.
+TRAINS_CONFIG_ENV = "SMARTDISPLAY_TRAINS"
+
+DEFAULT_CONFIG: Dict[str, Any] = {
+    "routes": {
+        "to_london": {
+            "crs": "WGC",
+            "direction": "departures",
+            "exclude": NORTH_STATIONS,
+        },
+        "from_london": {
+            "crs": "WGC",
+            "direction": "arrivals",
+            "exclude": SOUTH_STATIONS,
+        },
+    },
+}
 
 HTML_RE = re.compile(r"<[^>]+?>")
+TIME_RE = re.compile(r"\d\d:\d\d")
+
+
+def get_darwin() -> DarwinLdbSession:
+    global _DARWIN
+    with _DARWIN_LOCK:
+        if _DARWIN is None:
+            _DARWIN = DarwinLdbSession(wsdl=DARWIN_WSDL)
+        return _DARWIN
+
+
+def get_station_board(crs: str, departures: bool) -> Board:
+    return upstream_call(
+        DARWIN_BOARD,
+        f"{crs}:{'departures' if departures else 'arrivals'}",
+        lambda: _board_to_dict(get_darwin().get_station_board(
+                                crs=crs,
+                                include_departures=departures,
+                                include_arrivals=not departures)))
+
+
+def get_service_details(service_id: str) -> Dict[str, Optional[str]]:
+    return upstream_call(
+        DARWIN_SERVICE,
+        service_id,
+        lambda: _details_to_dict(get_darwin().get_service_details(service_id)))
+
+
+def _text(value: Any) -> Optional[str]:
+    return None if value is None else str(value)
+
+
+def _board_to_dict(board: Any) -> Board:
+    return {
+        "nrcc_messages": [str(msg) for msg in board.nrcc_messages],
+        "train_services": [{
+            "service_id": _text(train.service_id),
+            "destination_text": _text(train.destination_text),
+            "origin_text": _text(train.origin_text),
+            "platform": _text(train.platform),
+            "std": _text(train.std),
+            "etd": _text(train.etd),
+            "sta": _text(train.sta),
+            "eta": _text(train.eta),
+        } for train in board.train_services]
+    }
+
+
+def _details_to_dict(details: Any) -> Dict[str, Optional[str]]:
+    return {
+        "disruption_reason": _text(details.disruption_reason),
+        "overdue_message": _text(details.overdue_message),
+    }
 
 
 class BoardCache:
-    def __init__(self, departures: bool) -> None:
+    def __init__(self,
+                 crs: str,
+                 departures: bool,
+                 min_refresh: int,
+                 max_refresh: int) -> None:
+        self.crs = crs
         self.departures = departures
+        self.key = (crs, departures)
+        self.interval = AdaptiveInterval(min_refresh, max_refresh)
         self.last_update: Optional[datetime] = None
-        self.board: Optional[StationBoard] = None
-
-    def get(self) -> StationBoard:
-        if self.last_update is None \
-           or (datetime.utcnow() - self.last_update).total_seconds() > 300:
-            self.board = DARWIN.get_station_board(
-                                    crs='WGC',
-                                    include_departures=self.departures,
-                                    include_arrivals=not self.departures)
-            self.last_update = datetime.utcnow()
-        return self.board
-
-
-DEPARTURE_BOARD = BoardCache(True)
-ARRIVALS_BOARD = BoardCache(False)
-
-
-def get_trains_to_london() -> List[Dict[str, str | bool]]:
-    board = DEPARTURE_BOARD.get()
-
-    r: List[Dict[str, str | bool]] = []
-
-    for train in board.train_services:
-        if train.destination_text in NORTH_STATIONS:
-            continue
-        r.append({
-            "destination": train.destination_text,
-            "platform": train.platform,
-            "scheduled": train.std,
-            "eta": train.etd,
-            "is_late": _is_late(train.std, train.etd)
-        })
-
-    return r
-
-
-def get_trains_from_london() -> List[Dict[str, str | bool]]:
-    board = ARRIVALS_BOARD.get()
-
-    r: List[Dict[str, str | bool]] = []
-
-    for train in board.train_services:
-        if train.destination_text in SOUTH_STATIONS:
-            continue
-        details = DARWIN.get_service_details(train.service_id)
-        r.append({
-            "destination": train.origin_text,
-            "platform": train.platform,
-            "scheduled": train.sta,
-            "eta": train.eta,
-            "is_late": _is_late(train.sta, train.eta),
-            "message": details.disruption_reason or details.overdue_message
-        })
-
-    return r
-
-
-def get_trains_message() -> Optional[str]:
-    msg = " ".join(DEPARTURE_BOARD.get().nrcc_messages)
-
-    msg = HTML_RE.sub("", msg)
-    msg = msg.replace("\n", " ")
-    while "  " in msg:
-        msg = msg.replace("  ", " ")
-    msg = msg.replace(" More details can be found in Latest Travel News.", "")
-    msg = msg.replace(
-        " Latest information can be found in Status and Disruptions.", "")
-    return msg.strip()
+        # Set while the board is one restored from the snapshot or kept from
+        # before a failed refresh.
+        self.stale = False
+        # Destinations that none of the routes on this board show.
+        self.exclude: Optional[FrozenSet[str]] = None
+
+    def get(self) -> Board:
+        board = BOARDS.get(self.key)
+        if board is not MISSING:
+            return board
+        try:
+            return SINGLE_FLIGHT.do(("board", self.crs, self.departures),
+                                    self._refresh)
+        except Exception as e:
+            board = BOARDS.get(self.key, stale=True)
+            if board is MISSING:
+                raise
+            sys.stderr.write(f"Using last known {self.crs} board: {e!r}\n")
+            self.stale = True
+            return board
+
+    def last_board(self) -> Optional[Board]:
+        board = BOARDS.get(self.key, stale=True)
+        return None if board is MISSING else board
+
+    def restore(self, board: Board, last_update: datetime) -> None:
+        # Refreshed on first use unless still recent.
+        age = (datetime.utcnow() - last_update).total_seconds()
+        BOARDS.put(self.key, board, max(0.0, self.interval.interval - age))
+        self.last_update = last_update
+        self.stale = True
+
+    def _refresh(self) -> Board:
+        board = get_station_board(self.crs, self.departures)
+        hint = self.interval.minimum if self._train_due(board) else None
+        BOARDS.put(self.key, board, self.interval.update(board, hint))
+        self.last_update = datetime.utcnow()
+        self.stale = False
+        return board
+
+    def _train_due(self, board: Board) -> bool:
+        now = datetime.now(tz=ZoneInfo("Europe/London"))
+        minute = now.hour * 60 + now.minute
+        for train in board["train_services"]:
+            if self.exclude is not None \
+               and train["destination_text"] in self.exclude:
+                continue
+            time = train["std"] if self.departures else train["sta"]
+            if time is None or not TIME_RE.fullmatch(time):
+                continue
+            hour, minutes = time.split(":")
+            due = int(hour) * 60 + int(minutes)
+            # Boards run past midnight.
+            if (due - minute) % (24 * 60) * 60 < NEAR_DEPARTURE:
+                return True
+        return False
+
+
+class Route:
+    def __init__(self,
+                 name: str,
+                 board: BoardCache,
+                 exclude: Iterable[str]) -> None:
+        self.name = name
+        self.board = board
+        self.exclude = frozenset(exclude)
+
+        # The filtered trains only change when the board is refreshed.
+        self._lock = threading.Lock()
+        self._source: Optional[Board] = None
+        self._trains: List[Dict[str, str | bool | None]] = []
+
+    def trains(self) -> List[Dict[str, str | bool | None]]:
+        board = self.board.get()
+        with self._lock:
+            if board is self._source:
+                return self._trains
+
+        if self.board.departures:
+            trains = self._departures(board)
+        else:
+            trains = self._arrivals(board)
+
+        with self._lock:
+            self._source = board
+            self._trains = trains
+        return trains
+
+    def message(self) -> str:
+        msg = " ".join(self.board.get()["nrcc_messages"])
+
+        msg = HTML_RE.sub("", msg)
+        msg = msg.replace("\n", " ")
+        while "  " in msg:
+            msg = msg.replace("  ", " ")
+        msg = msg.replace(" More details can be found in Latest Travel News.",
+                          "")
+        msg = msg.replace(
+            " Latest information can be found in Status and Disruptions.", "")
+        return msg.strip()
+
+    def _departures(self, board: Board) -> List[Dict[str, str | bool | None]]:
+        r: List[Dict[str, str | bool | None]] = []
+
+        for train in board["train_services"]:
+            if train["destination_text"] in self.exclude:
+                continue
+            r.append({
+                "destination": train["destination_text"],
+                "platform": train["platform"],
+                "scheduled": train["std"],
+                "eta": train["etd"],
+                "is_late": _is_late(train["std"], train["etd"])
+            })
+
+        return r
+
+    def _arrivals(self, board: Board) -> List[Dict[str, str | bool | None]]:
+        r: List[Dict[str, str | bool | None]] = []
+
+        for train in board["train_services"]:
+            if train["destination_text"] in self.exclude:
+                continue
+            details = get_service_details(train["service_id"])
+            r.append({
+                "destination": train["origin_text"],
+                "platform": train["platform"],
+                "scheduled": train["sta"],
+                "eta": train["eta"],
+                "is_late": _is_late(train["sta"], train["eta"]),
+                "message": details["disruption_reason"]
+                or details["overdue_message"]
+            })
+
+        return r
+
+
+class TrainConfig:
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self.boards: Dict[Tuple[str, bool], BoardCache] = {}
+        self.routes: Dict[str, Route] = {}
+        self.displays: Dict[str, Dict[str, str]] = config.get("displays", {})
+
+        for name, route in config["routes"].items():
+            direction = route.get("direction", "departures")
+            if direction not in ("departures", "arrivals"):
+                raise ValueError(f"Route {name} has unknown direction "
+                                 f"{direction}")
+            departures = direction == "departures"
+            max_refresh = int(route.get("refresh", DEFAULT_REFRESH))
+            min_refresh = min(max_refresh,
+                              int(route.get("min_refresh",
+                                            DEFAULT_MIN_REFRESH)))
+            key = (route["crs"].upper(), departures)
+            board = self.boards.get(key)
+            if board is None:
+                board = BoardCache(key[0], departures,
+                                   min_refresh, max_refresh)
+                self.boards[key] = board
+            # Routes sharing a board get the most frequent refresh asked for.
+            board.interval.minimum = min(board.interval.minimum, min_refresh)
+            board.interval.maximum = min(board.interval.maximum, max_refresh)
+            self.routes[name] = Route(name, board, route.get("exclude", []))
+            exclude = self.routes[name].exclude
+            board.exclude = exclude if board.exclude is None \
+                else board.exclude & exclude
+
+        for display, overrides in self.displays.items():
+            for name, override in overrides.items():
+                if override not in self.routes:
+                    raise ValueError(f"Display {display} shows undefined "
+                                     f"route {override} for {name}")
+
+    def snapshot(self) -> List[Any]:
+        boards = []
+        for (crs, departures), board in self.boards.items():
+            data = board.last_board()
+            if data is not None and board.last_update is not None:
+                boards.append([crs, departures, data,
+                               board.last_update.isoformat()])
+        return boards
+
+    def restore(self, boards: List[Any]) -> None:
+        for crs, departures, data, last_update in boards:
+            board = self.boards.get((crs, departures))
+            if board is not None and board.last_board() is None:
+                board.restore(data, datetime.fromisoformat(last_update))
+
+    def route(self, name: str, display: Optional[str] = None) -> Route:
+        if display is not None:
+            name = self.displays.get(display, {}).get(name, name)
+        return self.routes[name]
+
+
+def load_train_config() -> TrainConfig:
+    path = os.environ.get(TRAINS_CONFIG_ENV)
+    if path is None:
+        return TrainConfig(DEFAULT_CONFIG)
+    print(f"Loading train routes from {path}")
+    with open(path, "r", encoding="utf8") as f:
+        return TrainConfig(json.load(f))
+
+
+TRAINS = load_train_config()
+
+
+# Cheap to recompute from the board, which decides how fresh they are.
+@panel_cache(max_ttl=PANEL_TTL)
+def get_trains(route: str, display: Optional[str] = None
+               ) -> List[Dict[str, str | bool | None]]:
+    return TRAINS.route(route, display).trains()
+
+
+@panel_cache(max_ttl=PANEL_TTL)
+def get_trains_message(route: str = "to_london",
+                       display: Optional[str] = None) -> Optional[str]:
+    return TRAINS.route(route, display).message()
+
+
+def get_trains_to_london(display: Optional[str] = None
+                         ) -> List[Dict[str, str | bool | None]]:
+    return get_trains("to_london", display)
+
+
+def get_trains_from_london(display: Optional[str] = None
+                           ) -> List[Dict[str, str | bool | None]]:
+    return get_trains("from_london", display)
 
 
 def _is_late(scheduled: str, estimated: str) -> bool:
@@ -1,26 +1,26 @@
-from typing import Dict
+from typing import Any, Dict
 
-from prometheus_api_client import PrometheusConnect  # type:ignore
+from .counters import IncrementalCounter
+from .panel_cache import panel_cache
+from .prometheus import Panel
 
+WATER = IncrementalCounter("watermeter_count")
+WATER_COST = IncrementalCounter("watercost_total")
+GAS = IncrementalCounter("glowprom_import_cumulativevol_m3")
+GAS_COST = IncrementalCounter("octopus_cost{type=\"gas\"}")
 
-def get_water_gas() -> Dict[str, float | str]:
-    prom = PrometheusConnect(url="http://192.168.1.207:9090")
 
-    return {
-        "water_day": _get_query(prom, "increase(watermeter_count[24h])"),
-        "water_cost": _get_query(prom, "increase(watercost_total[24h])"),
-        "gas_day":
-            _get_query(prom,
-                       "increase(glowprom_import_cumulativevol_m3[24h])"),
-        "gas_cost": _get_query(prom,
-                               "increase(octopus_cost{type=\"gas\"}[24h])"),
-    }
+# Daily totals, nobody needs them to the second.
+@panel_cache(min_ttl=60, max_ttl=300)
+def get_water_gas() -> Dict[str, Any]:
+    panel = Panel("water_gas")
 
-
-def _get_query(prom: PrometheusConnect, query: str) -> float:
-    data = prom.custom_query(query)
-
-    return float(data[0]["value"][1])
+    return panel.result({
+        "water_day": panel.value("water_day", WATER.value),
+        "water_cost": panel.value("water_cost", WATER_COST.value),
+        "gas_day": panel.value("gas_day", GAS.value),
+        "gas_cost": panel.value("gas_cost", GAS_COST.value),
+    })
 
 
 if __name__ == "__main__":
@@ -0,0 +1,29 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+from typing import Callable, Optional, ParamSpec, TypeVar
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+class BoundedExecutor:
+    def __init__(self,
+                 name: str,
+                 max_workers: int = 2,
+                 max_pending: int = 2) -> None:
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+
+    def submit(self,
+               func: Callable[P, T],
+               *args: P.args,
+               **kwargs: P.kwargs) -> Optional[Future[T]]:
+        # Rather than queueing without limit, refuse work once every worker
+        # is busy and the queue is full.
+        if not self._slots.acquire(blocking=False):
+            return None
+        future = self._executor.submit(func, *args, **kwargs)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future